@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""
+Benchmarks for the hot paths of :mod:`chaturbate`.
+
+Usage::
+
+    $ python benchmark.py followed
+    $ python benchmark.py embed [saved_model_page.html ...]
+    $ python benchmark.py simulate --models 500 --save-baseline base.json
+    $ python benchmark.py simulate --models 500 --baseline base.json
+
+``simulate`` runs the recorder against a local fake site, with stub
+rtmpdump and ffmpeg programs, and fails when a result regressed from the
+stored baseline.
+"""
+
+import os
+import re
+import sys
+import json
+import random
+import argparse
+import io
+import shutil
+import tempfile
+import threading
+import hashlib
+import time
+import timeit
+import logging
+if sys.version_info[0] < 3:
+    import ConfigParser as configparser
+    from SocketServer import ThreadingMixIn
+else:
+    import configparser
+    from socketserver import ThreadingMixIn
+
+import chaturbate
+
+STUB_RTMPDUMP = r"""
+import os
+import sys
+import time
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+args = sys.argv[1:]
+if '--help' in args:
+    print('--weeb')
+    sys.exit(0)
+
+room = args[args.index('--pageUrl') + 1].rstrip('/').rsplit('/', 1)[-1]
+output = args[args.index('--flv') + 1]
+rate = int(os.environ.get('BENCH_RATE', '65536'))
+
+
+def status():
+    try:
+        return urlopen(os.environ['BENCH_SITE'] + 'status/' + room).read()
+    except Exception:
+        return b'offline'
+
+if status() != b'online':
+    sys.exit(1)
+
+if output == '-':
+    stream = getattr(sys.stdout, 'buffer', sys.stdout)
+else:
+    stream = open(output, 'wb')
+chunk = b'\0' * max(rate // 10, 1)
+checked = time.time()
+try:
+    stream.write(b'FLV\x01\x05\x00\x00\x00\x09')
+    while True:
+        stream.flush()
+        time.sleep(0.1)
+        stream.write(chunk)
+        if time.time() - checked >= 1:
+            checked = time.time()
+            if status() != b'online':
+                break
+except (IOError, OSError):
+    pass
+"""
+"""Stands in for rtmpdump, streams zeros while the fake site says the model
+is online."""
+
+STUB_FFMPEG = r"""
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+source = args[args.index('-i') + 1]
+rate = int(os.environ.get('BENCH_FFMPEG_RATE', '0'))
+if source == '-':
+    stream = getattr(sys.stdin, 'buffer', sys.stdin)
+else:
+    stream = open(source, 'rb')
+with open(args[-1], 'wb') as output:
+    while True:
+        data = stream.read(65536)
+        if not data:
+            break
+        output.write(data)
+        if rate:
+            time.sleep(len(data) / float(rate))
+"""
+"""Stands in for ffmpeg, copies its input, optionally at a limited rate."""
+
+
+def make_followed_page(count, seed=0):
+    """
+    Generates a synthetic followed cams page.
+
+    :param int count: Number of models in the list.
+    :param int seed: Random seed, so runs are comparable.
+
+    :return: The HTML source.
+    :rtype: str
+    """
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        state = rng.random()
+        if state < 0.6:
+            label = '<div class="thumbnail_label thumbnail_label_offline">' \
+                    'OFFLINE</div>'
+        elif state < 0.7:
+            label = '<div class="thumbnail_label ' \
+                    'thumbnail_label_c_private_show">IN PRIVATE</div>'
+        else:
+            label = '<div class="thumbnail_label thumbnail_label_c">' \
+                    'HD</div>'
+        items.append(
+            '<li class="cams">'
+            '<a href="/model%d/"><img src="https://example.com/%d.jpg" '
+            'width="180" height="101" alt="model%d"></a>%s'
+            '<div class="details"><div class="title">'
+            '<a href="/model%d/">model%d</a><span class="age">%d</span>'
+            '</div><ul class="sub-info"><li class="location">Somewhere</li>'
+            '<li class="cams">%d viewers</li></ul></div></li>'
+            % (i, i, i, label, i, i, 18 + i % 40, rng.randint(0, 5000)))
+
+    return ('<!DOCTYPE html><html><head><title>Followed</title></head><body>'
+            '<div id="user_information"></div><div class="content">'
+            '<ul class="list">%s</ul></div>'
+            '<ul class="footer"><li><a href="/about/">About</a></li></ul>'
+            '</body></html>' % ''.join(items))
+
+
+def make_model_page(model, padding=2000):
+    """
+    Generates a synthetic model page with an EmbedViewerSwf call.
+
+    :param str model: The model name.
+    :param int padding: Number of filler lines around the call, real pages
+                        carry a lot of markup and scripts.
+
+    :return: The HTML source.
+    :rtype: str
+    """
+    filler = '\n'.join('<div class="filler">line %d of %s</div>' % (i, model)
+                       for i in range(padding))
+    embed = ("<script>\nEmbedViewerSwf(\n"
+             "            'https://example.com/CBV_2p650.swf',\n"
+             "            '%(model)s',\n"
+             "            'edge123.stream.highwebmedia.com',\n"
+             "            'en',\n"
+             "            '0',\n"
+             "            'false',\n"
+             "            '1',\n"
+             "            '0',\n"
+             "            'viewer',\n"
+             "            '/%(model)s/',\n"
+             "            '0',\n"
+             "            '0',\n"
+             "            'true',\n"
+             "            'false',\n"
+             "            '0',\n"
+             "            'pbkdf2_sha256%%24abc%%3D',\n"
+             "            'last'\n"
+             "            );\n</script>\n") % {'model': model}
+    return ('<html><head></head><body>%s\n%s%s</body></html>'
+            % (filler, embed, filler))
+
+
+class FakeSite(object):
+    """
+    Local stand-in for the site, serves a followed cams list of ``count``
+    models, their model pages and a ``/status/<model>`` page for the stub
+    rtmpdump.
+
+    Every second a ``churn`` fraction of the models changes state, and
+    every request waits ``latency`` seconds. The followed cams list is
+    split in pages of ``per_page`` models (0 for one page) and supports
+    ``If-None-Match``.
+    """
+
+    def __init__(self, count, churn=0.01, latency=0.0, per_page=0, seed=0):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.churn = churn
+        self.per_page = per_page
+        self.lock = threading.Lock()
+        self.models = ['model%d' % i for i in range(count)]
+        self.states = {}
+        self.since = {}
+        now = timeit.default_timer()
+        for model in self.models:
+            self.states[model] = self.pick()
+            self.since[model] = now
+        self.requests = 0
+        self.running = True
+
+        site = self
+
+        class Handler(chaturbate.BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, chaturbate.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        for target in (self.server.serve_forever, self.change):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def pick(self):
+        state = self.rng.random()
+        if state < 0.5:
+            return 'offline'
+        if state < 0.6:
+            return 'private'
+        return 'online'
+
+    def change(self):
+        """
+        Changes the state of some models every second.
+        """
+        while self.running:
+            time.sleep(1)
+            with self.lock:
+                now = timeit.default_timer()
+                changes = int(round(len(self.models) * self.churn))
+                for model in self.rng.sample(self.models, changes):
+                    state = self.pick()
+                    if state != self.states[model]:
+                        self.states[model] = state
+                        self.since[model] = now
+
+    def followed_page(self, page):
+        """
+        Renders a page of the followed cams list.
+
+        :param int page: The page number, starting at 1.
+
+        :rtype: str
+        """
+        models = self.models
+        pages = 1
+        if self.per_page:
+            pages = max((len(models) - 1) // self.per_page + 1, 1)
+            models = models[(page - 1) * self.per_page:page * self.per_page]
+        labels = {
+            'offline': '<div class="thumbnail_label thumbnail_label_offline">'
+                       'OFFLINE</div>',
+            'private': '<div class="thumbnail_label '
+                       'thumbnail_label_c_private_show">IN PRIVATE</div>',
+            'online': '<div class="thumbnail_label thumbnail_label_c">'
+                      'HD</div>',
+        }
+        with self.lock:
+            items = ['<li class="cams"><a href="/%s/">%s</a>%s'
+                     '<div class="details"><div class="title">'
+                     '<a href="/%s/">%s</a></div></div></li>'
+                     % (model, model, labels[self.states[model]], model,
+                        model) for model in models]
+        links = ''.join('<a href="/followed-cams/?page=%d">%d</a>'
+                        % (number, number) for number in range(2, pages + 1))
+        return ('<html><body><div id="user_information"></div>'
+                '<ul class="list">%s</ul>%s</body></html>'
+                % (''.join(items), links))
+
+    def handle(self, handler):
+        """
+        Answers a request of the recorder or of the stub rtmpdump.
+        """
+        with self.lock:
+            self.requests += 1
+        path = handler.path
+        if path.startswith('/status/'):
+            with self.lock:
+                body = self.states.get(path.split('/')[2], 'offline')
+        else:
+            if self.latency:
+                time.sleep(self.latency)
+            if path.startswith('/followed-cams/'):
+                page = 1
+                match = re.search(r'page=(\d+)', path)
+                if match:
+                    page = int(match.group(1))
+                body = self.followed_page(page)
+            else:
+                body = make_model_page(path.strip('/'), padding=200).replace(
+                    '<body>', '<body><div id="user_information"></div>', 1)
+
+        body = body.encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if handler.headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.end_headers()
+            return
+        handler.send_response(200)
+        handler.send_header('ETag', etag)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def stop(self):
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BenchRecorder(chaturbate.Chaturbate):
+    """
+    A recorder that notes when each capture started.
+    """
+
+    def __init__(self):
+        self.started = {}
+        chaturbate.Chaturbate.__init__(self)
+
+    def capture(self, flv_info):
+        self.started.setdefault(flv_info.room, timeit.default_timer())
+        chaturbate.Chaturbate.capture(self, flv_info)
+
+
+def cpu_usage():
+    """
+    Returns the CPU time used by this process and its finished children.
+
+    :return: Seconds, or None when the resource module is unavailable.
+    :rtype: tuple
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime)
+
+
+def rss():
+    """
+    Returns the memory this process currently uses.
+
+    ``ru_maxrss`` is the peak since the process started, so it can't tell
+    what a part of the run added.
+
+    :return: Bytes, or None when ``/proc`` is unavailable.
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, fraction):
+    """
+    :return: The value at a fraction of the sorted values, or 0.
+    :rtype: float
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def write_config(workdir, args):
+    """
+    Writes a config.ini for a simulation from config.ini.dist.
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'config.ini.dist'))
+    values = {
+        ('Directories', 'capturing'): os.path.join(workdir, 'capturing'),
+        ('Directories', 'complete'): os.path.join(workdir, 'complete'),
+        ('FFmpeg', 'enable'): 'true' if args.ffmpeg else 'false',
+        ('Journal', 'path'): '',
+        ('Probe', 'timeout'): '1',
+        ('Storage', 'min-free'): '0',
+        ('Workers', 'probes'): str(args.workers),
+    }
+    for (section, option), value in values.items():
+        config.set(section, option, value)
+    with open(os.path.join(workdir, 'config.ini'), 'w') as f:
+        config.write(f)
+
+
+def simulate(args):
+    """
+    Runs the recorder against a fake site for some cycles.
+
+    :return: The results.
+    :rtype: dict
+    """
+    workdir = tempfile.mkdtemp(prefix='chaturbate-bench-')
+    bindir = os.path.join(workdir, 'bin')
+    os.mkdir(bindir)
+    for name, source in (('rtmpdump', STUB_RTMPDUMP),
+                         ('ffmpeg', STUB_FFMPEG)):
+        filename = os.path.join(bindir, name)
+        with open(filename, 'w') as f:
+            f.write('#!%s\n%s' % (sys.executable, source))
+        os.chmod(filename, 0o755)
+    write_config(workdir, args)
+
+    site = FakeSite(args.models, args.churn, args.latency, args.per_page)
+    environ = dict(os.environ)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['BENCH_SITE'] = site.url
+    os.environ['BENCH_RATE'] = str(args.rate)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    chaturbate.Chaturbate.base_url = site.url
+    recorder = None
+    try:
+        cpu_before = cpu_usage()
+        rss_before = rss()
+        recorder = BenchRecorder()
+        recorder.log.setLevel(logging.ERROR)
+        cycles = []
+        for _ in range(args.cycles):
+            started = timeit.default_timer()
+            recorder.do_cycle()
+            cycles.append(timeit.default_timer() - started)
+            time.sleep(args.pause)
+        captures = recorder.processes.count(
+            chaturbate.ProcessRegistry.CAPTURING)
+        cpu_after = cpu_usage()
+        rss_after = rss()
+    finally:
+        if recorder is not None:
+            recorder.kill_processes()
+        site.stop()
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    waits = [started - site.since[model]
+             for model, started in recorder.started.items()]
+    results = {
+        'cycle_p50_ms': percentile(cycles, 0.5) * 1000,
+        'cycle_max_ms': max(cycles) * 1000,
+        'capture_p50_ms': percentile(waits, 0.5) * 1000,
+        'capture_p95_ms': percentile(waits, 0.95) * 1000,
+        'captures': captures,
+        'requests': site.requests,
+    }
+    if cpu_before[0] is not None:
+        cycle_models = float(args.models * args.cycles)
+        results['cpu_us_per_model_cycle'] = \
+            (cpu_after[0] - cpu_before[0]) / cycle_models * 1e6
+    if rss_before is not None:
+        # only what the recorder added, not the interpreter and the setup
+        results['rss_kb_per_model'] = \
+            (rss_after - rss_before) / 1024.0 / args.models
+    return results
+
+
+LOWER_IS_BETTER = ('cycle_p50_ms', 'cycle_max_ms', 'capture_p50_ms',
+                   'capture_p95_ms', 'cpu_us_per_model_cycle',
+                   'rss_kb_per_model')
+"""Results compared with the baseline."""
+
+
+def compare(results, baseline, tolerance):
+    """
+    Finds the results that got worse than the baseline.
+
+    Differences under 1ms (or 1 unit) are ignored as noise.
+
+    :param dict results: The current results.
+    :param dict baseline: The stored results.
+    :param float tolerance: Allowed relative increase.
+
+    :return: Descriptions of the regressions.
+    :rtype: list
+    """
+    regressions = []
+    for name in LOWER_IS_BETTER:
+        if name not in results or name not in baseline:
+            continue
+        limit = baseline[name] * (1 + tolerance)
+        if results[name] > limit and results[name] - baseline[name] > 1:
+            regressions.append("%s: %.2f > %.2f" % (
+                name, results[name], baseline[name]))
+    return regressions
+
+
+def bench_simulate(args):
+    """
+    Simulates a full recorder run and compares it with a baseline.
+    """
+    results = simulate(args)
+    key = 'simulate-%d' % args.models
+    for name in sorted(results):
+        print("%-24s %12.2f" % (name, results[name]))
+
+    if args.save_baseline:
+        baselines = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as f:
+                baselines = json.load(f)
+        baselines[key] = results
+        with open(args.save_baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+        if key not in baselines:
+            sys.exit("no %s baseline in %s" % (key, args.baseline))
+        regressions = compare(results, baselines[key], args.tolerance)
+        if regressions:
+            sys.exit("Regressions:\n  " + "\n  ".join(regressions))
+        print("No regressions against %s" % args.baseline)
+
+
+def legacy_flv_info(html):
+    """
+    The EmbedViewerSwf extraction as it was before :class:`StreamInfo`.
+
+    :param str html: The HTML source.
+
+    :return: A positional list with the arguments.
+    :rtype: list
+    """
+    flv_info = []
+    embed = re.search(r"EmbedViewerSwf\(*(.+?)\);", html, re.DOTALL)
+    if embed is None:
+        return flv_info
+    for line in embed.group(1).split("\n"):
+        data = re.search(r" +[\"'](.*)?[\"'],", line)
+        if data:
+            flv_info.append(data.group(1))
+    return flv_info
+
+
+def measure(function, argument, repeat):
+    """
+    Runs a function several times and returns the best duration.
+
+    :param function: The function to run.
+    :param argument: Argument to pass to the function.
+    :param int repeat: How many times to run it.
+
+    :return: Best duration in seconds.
+    :rtype: float
+    """
+    best = None
+    for _ in range(repeat):
+        started = timeit.default_timer()
+        function(argument)
+        elapsed = timeit.default_timer() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(function, argument):
+    """
+    Returns the peak memory allocated while running a function.
+
+    :param function: The function to run.
+    :param argument: Argument to pass to the function.
+
+    :return: Peak in bytes, or None when tracemalloc is unavailable.
+    :rtype: int
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+
+    tracemalloc.start()
+    function(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_followed(args):
+    """
+    Compares the followed cams parser backends.
+    """
+    backends = sorted(chaturbate.FOLLOWED_PARSERS)
+    print("%-8s %-12s %12s %12s" % ('models', 'backend', 'best', 'peak'))
+    for count in args.sizes:
+        html = make_followed_page(count)
+        expected = chaturbate.parse_followed_bs4(html)
+        for name in backends:
+            parse = chaturbate.FOLLOWED_PARSERS[name]
+            if parse(html) != expected:
+                sys.exit("%s returned a different list" % name)
+            elapsed = measure(parse, html, args.repeat)
+            peak = peak_memory(parse, html)
+            print("%-8d %-12s %10.2fms %12s" % (
+                count, name, elapsed * 1000,
+                chaturbate.Chaturbate.get_human_size(peak)
+                if peak is not None else '-'))
+
+
+def bench_embed(args):
+    """
+    Compares the legacy EmbedViewerSwf extraction with the current one.
+    """
+    pages = []
+    for filename in args.pages:
+        with io.open(filename, encoding='utf-8', errors='replace') as f:
+            pages.append((filename, f.read()))
+    if not pages:
+        pages.append(('synthetic', make_model_page('model0')))
+
+    print("%-24s %12s %12s" % ('page', 'legacy', 'current'))
+    for name, html in pages:
+        stream = chaturbate.extract_stream_info(html)
+        if list(stream.args) != legacy_flv_info(html):
+            sys.exit("%s: extractors disagree" % name)
+        legacy = measure(legacy_flv_info, html, args.repeat)
+        current = measure(chaturbate.extract_stream_info, html, args.repeat)
+        print("%-24s %10.3fms %10.3fms" % (
+            name[-24:], legacy * 1000, current * 1000))
+
+
+def main():
+    """
+    Parses the command line and runs the chosen benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', type=int, default=5)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    followed = subparsers.add_parser(
+        'followed', help='followed cams page parsers')
+    followed.add_argument('--sizes', type=int, nargs='+',
+                          default=[100, 500, 1000, 5000])
+    followed.set_defaults(function=bench_followed)
+
+    embed = subparsers.add_parser(
+        'embed', help='EmbedViewerSwf extraction')
+    embed.add_argument('pages', nargs='*',
+                       help='saved model pages, a synthetic one by default')
+    embed.set_defaults(function=bench_embed)
+
+    simulation = subparsers.add_parser(
+        'simulate', help='recorder against a fake site')
+    simulation.add_argument('--models', type=int, default=200)
+    simulation.add_argument('--churn', type=float, default=0.01,
+                            help='fraction of models changing per second')
+    simulation.add_argument('--latency', type=float, default=0.0,
+                            help='seconds added to every page request')
+    simulation.add_argument('--per-page', type=int, default=0,
+                            help='models per followed cams page')
+    simulation.add_argument('--rate', type=int, default=65536,
+                            help='bytes per second of each stub stream')
+    simulation.add_argument('--cycles', type=int, default=5)
+    simulation.add_argument('--pause', type=float, default=1.0,
+                            help='seconds between cycles')
+    simulation.add_argument('--workers', type=int, default=8)
+    simulation.add_argument('--ffmpeg', action='store_true',
+                            help='transcode the finished recordings')
+    simulation.add_argument('--baseline', help='JSON file to compare with')
+    simulation.add_argument('--save-baseline',
+                            help='JSON file to store the results in')
+    simulation.add_argument('--tolerance', type=float, default=0.2,
+                            help='allowed relative regression')
+    simulation.set_defaults(function=bench_simulate)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'function'):
+        parser.print_help()
+        sys.exit(1)
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,26 +10,2144 @@ The requirements are:
  * RTMPDump-ksv - https://github.com/BurntSushi/rtmpdump-ksv
  * BeautifulSoup - https://www.crummy.com/software/BeautifulSoup/
  * requests - http://docs.python-requests.org/en/master/
+
+Optional:
+ * lxml - http://lxml.de/ - faster parsing of the followed cams page
+
+With the ``native`` capture backend (Python 3.5+, see :mod:`native_capture`)
+rtmpdump is not needed.
+"""
+
+import os
+import sys
+if sys.version_info[0] < 3:
+    import ConfigParser
+    import Queue as queue
+    from HTMLParser import HTMLParser
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    DEVNULL = open(os.devnull, 'wb')
+else:
+    import configparser
+    import queue
+    from html.parser import HTMLParser
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from subprocess import DEVNULL
+
+import subprocess
+import select
+import re
+import urllib
+import time
+import json
+import errno
+import sqlite3
+import threading
+import heapq
+import bisect
+import itertools
+import random
+import struct
+import hashlib
+import tempfile
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
+import logging
+import logging.handlers
+import atexit
+import requests
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+LOG_RECORD_FIELDS = frozenset(
+    logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | \
+    frozenset(('message', 'asctime'))
+"""Attributes every log record has, the others come from ``extra``."""
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as JSON lines.
+
+    Fields passed with ``extra`` are kept as structured fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, sort_keys=True)
+
+
+class RequestError(Exception):
+    """
+    Raised when a page can't be fetched within the retry policy.
+    """
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction of the requests.
+
+    Every request deposits ``ratio`` tokens and every retry takes one, up to
+    ``capacity`` tokens, so during an outage the retries stop instead of
+    multiplying the load.
+    """
+
+    def __init__(self, ratio=0.2, capacity=10):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        """
+        Records a request.
+        """
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Asks for a retry.
+
+        :return: False if the budget is exhausted.
+        :rtype: bool
+        """
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests for ``cooldown`` seconds after ``threshold`` consecutive
+    failures. After the cooldown one request is let through to test the
+    site again.
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Checks if a request may be done.
+
+        :rtype: bool
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                # half open, the next failure opens it again
+                self.opened_at = None
+                self.failures = self.threshold - 1
+                return True
+            return False
+
+    def is_open(self):
+        """
+        :rtype: bool
+        """
+        return self.opened_at is not None
+
+    def success(self):
+        """
+        Records a successful request.
+        """
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """
+        Records a failed request.
+
+        :return: True if this failure opened the breaker.
+        :rtype: bool
+        """
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+class EmbedError(Exception):
+    """
+    Raised when the stream information can't be read from a model page.
+    """
+
+
+StreamInfo = namedtuple('StreamInfo', 'room server username password args')
+"""
+Immutable description of a stream, read from the EmbedViewerSwf call.
+
+``room`` is the model name, ``server`` the rtmp edge server, ``username``
+and ``password`` the credentials passed to it, and ``args`` every quoted
+argument of the call.
 """
 
-import os
-import sys
-if sys.version_info[0] < 3:
-    import ConfigParser
-    DEVNULL = open(os.devnull, 'wb')
-else:
-    import configparser
-    from subprocess import DEVNULL
+EMBED_ARGUMENT_RE = re.compile(r"^ +[\"'](.*)?[\"'],", re.MULTILINE)
+"""Matches one quoted argument per line of the EmbedViewerSwf call."""
+
+
+def extract_stream_info(html):
+    """
+    Reads the stream information from the EmbedViewerSwf call of a page.
+
+    Only the text between ``EmbedViewerSwf`` and the end of the call is
+    scanned.
+
+    :param str html: The HTML source of the model page.
+
+    :return: The stream information.
+    :rtype: StreamInfo
+
+    :raises EmbedError: If the call is missing or incomplete.
+    """
+    start = html.find('EmbedViewerSwf')
+    if start == -1:
+        raise EmbedError("no EmbedViewerSwf call in the page")
+
+    end = html.find(');', start)
+    if end == -1:
+        raise EmbedError("EmbedViewerSwf call is not terminated")
+
+    args = tuple(EMBED_ARGUMENT_RE.findall(html, start, end))
+    if len(args) < 16:
+        raise EmbedError("EmbedViewerSwf call has %d arguments, expected 16"
+                         % len(args))
+
+    return StreamInfo(room=args[1], server=args[2], username=args[8],
+                      password=args[15], args=args)
+
+
+def which(name):
+    """
+    Finds a program in the PATH.
+
+    :param str name: The program name.
+
+    :return: Its path, or None if it isn't installed.
+    :rtype: str
+    """
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def file_checksum(filename):
+    """
+    Returns the SHA-256 of a file.
+
+    :param str filename: The file.
+
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def copy_file(source, destination, verify=True):
+    """
+    Copies a file to another filesystem without going through user space
+    when possible.
+
+    ``os.copy_file_range`` is tried first, then ``os.sendfile``, then plain
+    reads and writes. The copy is written to a temporary name, fsynced and
+    renamed, so the destination is never left incomplete. The temporary file
+    is removed if anything fails.
+
+    :param str source: The source file.
+    :param str destination: The destination file.
+    :param bool verify: Compare the checksums of both files.
+
+    :return: Bytes copied and the checksum (None if not verified).
+    :rtype: tuple
+
+    :raises IOError: If the checksums don't match.
+    """
+    chunk = 8 * 1024 * 1024
+    temp_fn = destination + '.part'
+    copy_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+
+    try:
+        with open(source, 'rb') as src, open(temp_fn, 'wb') as dst:
+            src_fd = src.fileno()
+            dst_fd = dst.fileno()
+            size = os.fstat(src_fd).st_size
+            copied = 0
+            while copied < size:
+                count = min(chunk, size - copied)
+                copied_now = None
+                if copy_range is not None:
+                    try:
+                        copied_now = copy_range(src_fd, dst_fd, count,
+                                                copied, copied)
+                    except OSError:
+                        copy_range = None
+                if copied_now is None and sendfile is not None:
+                    os.lseek(dst_fd, copied, os.SEEK_SET)
+                    try:
+                        copied_now = sendfile(dst_fd, src_fd, copied, count)
+                    except OSError:
+                        sendfile = None
+                if copied_now is None:
+                    os.lseek(src_fd, copied, os.SEEK_SET)
+                    os.lseek(dst_fd, copied, os.SEEK_SET)
+                    copied_now = os.write(dst_fd, os.read(src_fd, count))
+                if copied_now == 0:
+                    break
+                copied += copied_now
+            os.fsync(dst_fd)
+
+        checksum = None
+        if verify:
+            checksum = file_checksum(source)
+            if file_checksum(temp_fn) != checksum:
+                raise IOError("checksum mismatch copying %s" % source)
+
+        os.rename(temp_fn, destination)
+    except BaseException:
+        # a full destination or a failed check, don't leave the part behind
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        raise
+    return copied, checksum
+
+
+class FollowedCamsParser(object):
+    """
+    Incremental parser for the followed cams page.
+
+    It is fed start and end tags by one of the parser backends and collects
+    ``(model, online, private)`` tuples for the ``li`` children of the
+    ``ul.list`` element, without building a DOM.
+    """
+    OFFLINE = 'thumbnail_label_offline'
+    PRIVATE = 'thumbnail_label_c_private_show'
+
+    def __init__(self):
+        self.models = []
+        self.depth = 0
+        self.done = False
+        self.current = None
+
+    def start(self, tag, attrs):
+        """
+        Handles a start tag.
+
+        :param str tag: Tag name.
+        :param dict attrs: Tag attributes.
+        """
+        if self.done:
+            return
+
+        if tag == 'ul':
+            if self.depth > 0:
+                self.depth += 1
+            elif 'list' in (attrs.get('class') or '').split():
+                self.depth = 1
+        elif self.depth == 0:
+            return
+        elif tag == 'li' and self.depth == 1:
+            self.close_model()
+            self.current = [None, True, False]
+        elif self.current is None:
+            return
+        elif tag == 'a':
+            if self.current[0] is None and attrs.get('href') is not None:
+                self.current[0] = attrs['href'].replace('/', '')
+        elif tag == 'div':
+            classes = (attrs.get('class') or '').split()
+            if self.OFFLINE in classes:
+                self.current[1] = False
+            if self.PRIVATE in classes:
+                self.current[2] = True
+
+    def end(self, tag):
+        """
+        Handles an end tag.
+
+        :param str tag: Tag name.
+        """
+        if self.depth == 0:
+            return
+
+        if tag == 'li' and self.depth == 1:
+            self.close_model()
+        elif tag == 'ul':
+            self.depth -= 1
+            if self.depth == 0:
+                self.close_model()
+                self.done = True
+
+    def close_model(self):
+        """
+        Stores the model being parsed, if any.
+        """
+        if self.current is not None and self.current[0] is not None:
+            self.models.append(tuple(self.current))
+        self.current = None
+
+
+class StdlibFollowedCamsParser(HTMLParser):
+    """
+    Feeds a :class:`FollowedCamsParser` from the standard library tokenizer.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.state = FollowedCamsParser()
+
+    def handle_starttag(self, tag, attrs):
+        self.state.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.state.start(tag, dict(attrs))
+        self.state.end(tag)
+
+    def handle_endtag(self, tag):
+        self.state.end(tag)
+
+
+def parse_followed_stdlib(html):
+    """
+    Parses the followed cams page with the standard library tokenizer.
+
+    Stops feeding the tokenizer once the list has been read.
+
+    :param str html: The HTML source.
+
+    :return: ``(model, online, private)`` tuples.
+    :rtype: list
+    """
+    parser = StdlibFollowedCamsParser()
+    chunk_size = 65536
+    for offset in range(0, len(html), chunk_size):
+        parser.feed(html[offset:offset + chunk_size])
+        if parser.state.done:
+            break
+    parser.state.close_model()
+    return parser.state.models
+
+
+def parse_followed_lxml(html):
+    """
+    Parses the followed cams page with the lxml pull parser.
+
+    Elements are cleared as soon as they end, so no tree is kept.
+
+    :param str html: The HTML source.
+
+    :return: ``(model, online, private)`` tuples.
+    :rtype: list
+    """
+    state = FollowedCamsParser()
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    chunk_size = 65536
+    for offset in range(0, len(html), chunk_size):
+        parser.feed(html[offset:offset + chunk_size])
+        for event, element in parser.read_events():
+            if event == 'start':
+                state.start(element.tag, element.attrib)
+            else:
+                state.end(element.tag)
+                element.clear()
+        if state.done:
+            break
+    state.close_model()
+    return state.models
+
+
+def parse_followed_bs4(html):
+    """
+    Parses the followed cams page with BeautifulSoup.
+
+    :param str html: The HTML source.
+
+    :return: ``(model, online, private)`` tuples.
+    :rtype: list
+    """
+    # BeautifulSoup is slow to import, only load it when it is used
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+
+    models = []
+    models_li = soup.find(
+        'ul', {'class': 'list'}).findAll('li', recursive=False)
+
+    for model in models_li:
+        model_name = model.find('a')['href'].replace('/', '')
+        offline = model.find('div', {'class': FollowedCamsParser.OFFLINE})
+        private = model.find('div', {'class': FollowedCamsParser.PRIVATE})
+        models.append((model_name, offline is None, private is not None))
+
+    return models
+
+
+FOLLOWED_PARSERS = {
+    'html.parser': parse_followed_stdlib,
+    'bs4': parse_followed_bs4,
+}
+"""Available backends to parse the followed cams page."""
+if etree is not None:
+    FOLLOWED_PARSERS['lxml'] = parse_followed_lxml
+
+
+class PageState(object):
+    """
+    What was learned from the last fetch of a followed cams page.
+    """
+    __slots__ = ('etag', 'modified', 'digest', 'models', 'pages')
+
+    def __init__(self):
+        self.etag = None
+        self.modified = None
+        self.digest = None
+        self.models = []
+        self.pages = 1
+
+
+FollowedDiff = namedtuple('FollowedDiff', ['online', 'offline', 'private'])
+"""Models that came online, went offline and went private."""
+
+
+def diff_followed(previous, current):
+    """
+    Compares two snapshots of the followed cams.
+
+    :param dict previous: Status (``online`` or ``private``) of the models
+                          that weren't offline on the last fetch.
+    :param dict current: The same, for this fetch.
+
+    :rtype: FollowedDiff
+    """
+    online = [model for model, status in current.items()
+              if status == 'online' and previous.get(model) != 'online']
+    private = [model for model, status in current.items()
+               if status == 'private' and previous.get(model) != 'private']
+    offline = [model for model in previous if model not in current]
+    return FollowedDiff(sorted(online), sorted(offline), sorted(private))
+
+
+class EventCounter(object):
+    """
+    Counts named events and reports how many happened in the last hour.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+        self.totals = {}
+
+    def hit(self, name):
+        """
+        Records an event.
+
+        :param str name: Event name.
+        """
+        now = time.time()
+        with self.lock:
+            events = self.events.setdefault(name, deque())
+            events.append(now)
+            self.totals[name] = self.totals.get(name, 0) + 1
+            self.expire(events, now)
+
+    def total(self, name):
+        """
+        Returns how many times an event happened since startup.
+
+        :param str name: Event name.
+
+        :rtype: int
+        """
+        return self.totals.get(name, 0)
+
+    def per_hour(self, name):
+        """
+        Returns how many times an event happened in the last hour.
+
+        :param str name: Event name.
+
+        :rtype: int
+        """
+        with self.lock:
+            events = self.events.get(name)
+            if events is None:
+                return 0
+            self.expire(events, time.time())
+            return len(events)
+
+    @staticmethod
+    def expire(events, now):
+        """
+        Drops the events older than one hour.
+
+        :param deque events: Event timestamps, oldest first.
+        :param float now: Current timestamp.
+        """
+        while events and events[0] < now - 3600:
+            events.popleft()
+
+
+class CacheEntry(object):
+    """
+    What :class:`DiscoveryCache` knows about one model.
+    """
+    __slots__ = ('stream', 'expires', 'blocked_until', 'failures', 'reason')
+
+    def __init__(self):
+        self.stream = None
+        self.expires = 0
+        self.blocked_until = 0
+        self.failures = 0
+        self.reason = None
+
+
+class DiscoveryCache(object):
+    """
+    Per model cache in front of the embed page fetch and the private probe.
+
+    Stream descriptors are kept for ``ttl`` seconds. Private shows and
+    missing embeds add a negative entry that blocks the model for
+    ``backoff`` seconds, doubling on every consecutive failure up to
+    ``max_backoff``. At most ``size`` models are kept, the least recently
+    used is evicted first.
+    """
+
+    def __init__(self, size=1000, ttl=300, backoff=60, max_backoff=3600):
+        self.size = size
+        self.ttl = ttl
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, model):
+        """
+        Returns the entry of a model and marks it as recently used.
+
+        :param str model: The model name.
+
+        :rtype: CacheEntry
+        """
+        entry = self.entries.pop(model, None)
+        if entry is None:
+            entry = CacheEntry()
+        self.entries[model] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def blocked(self, model):
+        """
+        Checks if a model has an active negative entry.
+
+        :param str model: The model name.
+
+        :return: The reason it is blocked, or None.
+        :rtype: str
+        """
+        with self.lock:
+            entry = self.entries.get(model)
+            if entry is not None and entry.blocked_until > time.time():
+                self.hits += 1
+                return entry.reason
+        return None
+
+    def get_stream(self, model):
+        """
+        Returns the cached stream descriptor of a model.
+
+        :param str model: The model name.
+
+        :return: The stream information, or None if not cached.
+        :rtype: StreamInfo
+        """
+        with self.lock:
+            entry = self.entries.get(model)
+            if entry is not None and entry.stream is not None and \
+                    entry.expires > time.time():
+                self.entry(model)
+                self.hits += 1
+                return entry.stream
+            self.misses += 1
+        return None
+
+    def put_stream(self, model, stream):
+        """
+        Caches the stream descriptor of a model.
+
+        :param str model: The model name.
+        :param StreamInfo stream: The stream information.
+        """
+        with self.lock:
+            entry = self.entry(model)
+            entry.stream = stream
+            entry.expires = time.time() + self.ttl
+
+    def drop_stream(self, model):
+        """
+        Drops the cached stream descriptor of a model, keeping its backoff.
+
+        :param str model: The model name.
+        """
+        with self.lock:
+            entry = self.entries.get(model)
+            if entry is not None:
+                entry.stream = None
+
+    def put_negative(self, model, reason):
+        """
+        Blocks a model, with exponential backoff.
+
+        :param str model: The model name.
+        :param str reason: Why the model is blocked.
+
+        :return: For how many seconds the model is blocked.
+        :rtype: float
+        """
+        with self.lock:
+            entry = self.entry(model)
+            delay = min(self.backoff * 2 ** entry.failures, self.max_backoff)
+            entry.blocked_until = time.time() + delay
+            entry.failures += 1
+            entry.reason = reason
+            return delay
+
+    def succeeded(self, model):
+        """
+        Clears the negative entry of a model.
+
+        :param str model: The model name.
+        """
+        with self.lock:
+            entry = self.entries.get(model)
+            if entry is not None:
+                entry.blocked_until = 0
+                entry.failures = 0
+                entry.reason = None
+
+    def forget(self, model):
+        """
+        Drops everything cached about a model.
+
+        :param str model: The model name.
+        """
+        with self.lock:
+            self.entries.pop(model, None)
+
+
+class Metrics(object):
+    """
+    Histograms and gauges, rendered in the Prometheus text format.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 120)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = OrderedDict()
+        self.histograms = {}
+        self.gauges = {}
+        self.labels = {}
+
+    def histogram(self, name, description):
+        """
+        Declares a histogram.
+
+        :param str name: Metric name.
+        :param str description: Help text.
+        """
+        self.help[name] = ('histogram', description)
+        self.histograms[name] = [[0] * len(self.BUCKETS), 0.0, 0]
+
+    def gauge(self, name, description, kind='gauge', label='model'):
+        """
+        Declares a gauge.
+
+        :param str name: Metric name.
+        :param str description: Help text.
+        :param str kind: ``counter`` for values that only go up.
+        :param str label: Name of the label of the values.
+        """
+        self.help[name] = (kind, description)
+        self.gauges[name] = {}
+        self.labels[name] = label
+
+    @staticmethod
+    def escape(value):
+        """
+        Escapes a label value for the text format.
+
+        :param str value: The value.
+
+        :rtype: str
+        """
+        return value.replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+    def observe(self, name, value):
+        """
+        Adds a value to a histogram.
+
+        :param str name: Metric name.
+        :param float value: The value, normally seconds.
+        """
+        with self.lock:
+            histogram = self.histograms[name]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def set(self, name, value, label=None):
+        """
+        Sets a gauge.
+
+        :param str name: Metric name.
+        :param float value: The value.
+        :param str label: Value of the label, the model name for per
+                          recording gauges.
+        """
+        with self.lock:
+            self.gauges[name][label] = value
+
+    def reset(self, name):
+        """
+        Removes every value of a gauge.
+
+        :param str name: Metric name.
+        """
+        with self.lock:
+            self.gauges[name] = {}
+
+    def render(self):
+        """
+        Renders all the metrics.
+
+        :return: Prometheus text exposition.
+        :rtype: str
+        """
+        lines = []
+        with self.lock:
+            for name, (kind, description) in self.help.items():
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s %s' % (name, kind))
+                if kind == 'histogram':
+                    buckets, total, count = self.histograms[name]
+                    for bound, value in zip(self.BUCKETS, buckets):
+                        lines.append('%s_bucket{le="%s"} %d'
+                                     % (name, bound, value))
+                    lines.append('%s_bucket{le="+Inf"} %d' % (name, count))
+                    lines.append('%s_sum %f' % (name, total))
+                    lines.append('%s_count %d' % (name, count))
+                    continue
+                for label, value in sorted(self.gauges[name].items(),
+                                           key=lambda item: item[0] or ''):
+                    if label is None:
+                        lines.append('%s %f' % (name, value))
+                    else:
+                        lines.append('%s{%s="%s"} %f'
+                                     % (name, self.labels[name],
+                                        self.escape(label), value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves :meth:`Metrics.render` on ``/metrics``.
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FlvSplitter(object):
+    """
+    Cuts an FLV byte stream into the file header and whole tags.
+
+    The metadata and the audio/video sequence headers are kept, so a new
+    file can be started at any keyframe and still be decodable.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header = None
+        self.metadata = None
+        self.video_config = None
+        self.audio_config = None
+        self.has_video = False
+
+    def feed(self, data):
+        """
+        Adds data and returns the complete units found.
+
+        :param bytes data: A piece of the stream.
+
+        :return: ``(unit, is_keyframe)`` tuples, the header is a unit too.
+        :rtype: list
+        """
+        buf = self.buffer
+        buf.extend(data)
+        units = []
+        offset = 0
+
+        if self.header is None:
+            if len(buf) < 13:
+                return units
+            self.header = bytes(buf[:13])
+            units.append((self.header, False))
+            offset = 13
+
+        while len(buf) - offset >= 11:
+            size = struct.unpack('>I', b'\0' + bytes(buf[offset + 1:
+                                                        offset + 4]))[0]
+            end = offset + 11 + size + 4
+            if end > len(buf):
+                break
+            tag_type = buf[offset] & 0x1f
+            tag = bytes(buf[offset:end])
+            keyframe = False
+            if tag_type == 9 and size > 1:
+                self.has_video = True
+                keyframe = buf[offset + 11] >> 4 == 1
+                if buf[offset + 11] & 0x0f == 7 and buf[offset + 12] == 0:
+                    self.video_config = tag
+                    keyframe = False
+            elif tag_type == 8 and size > 1:
+                if buf[offset + 11] >> 4 == 10 and buf[offset + 12] == 0:
+                    self.audio_config = tag
+            elif tag_type == 18 and self.metadata is None:
+                self.metadata = tag
+            units.append((tag, keyframe))
+            offset = end
+
+        del buf[:offset]
+        return units
+
+    def preamble(self):
+        """
+        Returns what a new file needs before its first keyframe.
+
+        :rtype: bytes
+        """
+        return b''.join(unit for unit in (self.header, self.metadata,
+                                          self.video_config,
+                                          self.audio_config)
+                        if unit is not None)
+
+
+class SegmentWriter(object):
+    """
+    Writes a stream into consecutive files, rotating them by duration or by
+    size.
+
+    FLV streams are only cut at video keyframes (or at any tag if there is no
+    video) and every file gets the headers it needs. Other streams, like HLS
+    transport stream segments, are cut between writes.
+    """
+
+    def __init__(self, filename, make_filename, on_rotate, duration=0,
+                 size=0, flv=True, first_byte=None):
+        """
+        :param str filename: The first file.
+        :param make_filename: Returns the name of the next file.
+        :param on_rotate: Called with the finished file, the new file and
+                          when the finished file was started.
+        :param float duration: Seconds per file, 0 to disable.
+        :param int size: Bytes per file, 0 to disable.
+        :param bool flv: If the stream is FLV.
+        :param first_byte: Called when the first data arrives.
+        """
+        self.make_filename = make_filename
+        self.on_rotate = on_rotate
+        self.first_byte = first_byte
+        self.duration = duration
+        self.size = size
+        self.splitter = FlvSplitter() if flv else None
+        self.lock = threading.Lock()
+        self.open(filename)
+
+    def open(self, filename):
+        """
+        Starts a new file.
+
+        :param str filename: The file name.
+        """
+        self.filename = filename
+        self.output = open(filename, 'wb', 1024 * 1024)
+        self.started = time.time()
+        self.written = 0
+
+    def due(self):
+        """
+        Checks if the current file is complete.
+
+        :rtype: bool
+        """
+        return (self.duration > 0 and
+                time.time() - self.started >= self.duration) or \
+            (0 < self.size <= self.written)
+
+    def rotate(self):
+        """
+        Closes the current file and starts the next one.
+        """
+        self.output.close()
+        finished = self.filename
+        started = self.started
+        self.open(self.make_filename())
+        self.on_rotate(finished, self.filename, started)
+
+    def write(self, data):
+        """
+        Writes a piece of the stream.
+
+        :param bytes data: The data.
+        """
+        with self.lock:
+            if self.first_byte is not None and data:
+                first_byte, self.first_byte = self.first_byte, None
+                first_byte()
+            if self.splitter is None:
+                if self.written > 0 and self.due():
+                    self.rotate()
+                self.output.write(data)
+                self.written += len(data)
+                return
+
+            for unit, keyframe in self.splitter.feed(data):
+                if self.written > 0 and self.due() and \
+                        (keyframe or not self.splitter.has_video):
+                    self.rotate()
+                    preamble = self.splitter.preamble()
+                    self.output.write(preamble)
+                    self.written += len(preamble)
+                self.output.write(unit)
+                self.written += len(unit)
+
+    def close(self):
+        """
+        Writes whatever is left and closes the current file.
+        """
+        with self.lock:
+            if self.splitter is not None and self.splitter.buffer:
+                self.output.write(bytes(self.splitter.buffer))
+            self.output.close()
+
+
+class PipedCapture(object):
+    """
+    Popen-like wrapper of a process whose stdout is copied to a
+    :class:`SegmentWriter` by a thread.
+
+    The capture is only over once the copy is finished.
+    """
+
+    def __init__(self, process, output):
+        self.process = process
+        self.pid = process.pid
+        self.output = output
+        self.thread = threading.Thread(target=self.copy)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def copy(self):
+        try:
+            while True:
+                data = os.read(self.process.stdout.fileno(), 65536)
+                if not data:
+                    break
+                self.output.write(data)
+        finally:
+            self.output.close()
+            self.process.stdout.close()
+
+    def poll(self):
+        """
+        :return: None while the capture is running.
+        """
+        if self.thread.is_alive():
+            return None
+        return self.process.poll()
+
+    def wait(self):
+        """
+        Waits until the process exits and its output is written.
+
+        The copy thread is a daemon, :meth:`Chaturbate.kill_processes`
+        relies on this to keep the last segment when the program exits.
+        """
+        self.process.wait()
+        self.thread.join()
+        return self.process.returncode
+
+    def terminate(self):
+        self.process.terminate()
+
+    def kill(self):
+        self.process.kill()
+
+
+class Pipeline(object):
+    """
+    Popen-like wrapper of a process piped into another one.
+
+    Terminating the pipeline only stops the producer, so the consumer sees
+    the end of its input and finishes its output properly.
+    """
+
+    def __init__(self, producer, consumer):
+        self.producer = producer
+        self.consumer = consumer
+        self.pid = consumer.pid
+
+    @property
+    def returncode(self):
+        return self.consumer.returncode
+
+    def poll(self):
+        """
+        :return: None while the consumer is running.
+        """
+        self.producer.poll()
+        return self.consumer.poll()
+
+    def wait(self):
+        """
+        Waits until both processes exit.
+        """
+        self.producer.wait()
+        return self.consumer.wait()
+
+    def terminate(self):
+        self.producer.terminate()
+
+    def kill(self):
+        self.producer.kill()
+        self.consumer.kill()
+
+
+class CaptureBackend(object):
+    """
+    Interface of the engines that record the streams.
+    """
+    name = None
+
+    def start(self, stream, filename, output=None, first_byte=None):
+        """
+        Starts recording a stream.
+
+        :param StreamInfo stream: The stream information.
+        :param str filename: Where to write the recording.
+        :param SegmentWriter output: Where to write instead of ``filename``.
+        :param first_byte: Called when the first data arrives, if the
+                           backend can tell.
+
+        :return: A Popen-like object with ``pid``, ``poll``, ``wait``,
+                 ``terminate`` and ``kill``.
+        """
+        raise NotImplementedError
+
+    def is_flv(self, stream):
+        """
+        Checks if the recording of a stream is FLV.
+
+        :param StreamInfo stream: The stream information.
+
+        :rtype: bool
+        """
+        return True
+
+    def start_piped(self, stream, arguments):
+        """
+        Starts recording a stream into the stdin of another program.
+
+        :param StreamInfo stream: The stream information.
+        :param list arguments: The program and its arguments.
+
+        :return: A Popen-like object, or None if it isn't supported.
+        """
+        return None
+
+    def check(self):
+        """
+        Exits if the backend found out it can't work.
+        """
+
+    def probe(self, stream, timeout):
+        """
+        Checks if a stream sends data, nothing is written to disk.
+
+        :param StreamInfo stream: The stream information.
+        :param float timeout: Seconds to wait for the first bytes.
+
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+
+class RtmpdumpBackend(CaptureBackend):
+    """
+    Records every stream with its own rtmpdump-ksv process.
+    """
+    name = 'rtmpdump'
+
+    def __init__(self, config):
+        self.detected = None
+        self.ksv = True
+        if config['startup-fast'] != 'true':
+            Chaturbate.detect_rtmpdump()
+            return
+        # checked in the background, captures wait for the result
+        self.detected = threading.Event()
+        thread = threading.Thread(target=self.detect)
+        thread.daemon = True
+        thread.start()
+
+    def detect(self):
+        try:
+            self.ksv = Chaturbate.check_rtmpdump()
+        except Exception:
+            self.ksv = False
+        finally:
+            self.detected.set()
+
+    def ready(self):
+        """
+        Waits for the background detection of rtmpdump-ksv.
+
+        :raises OSError: If it wasn't found.
+        """
+        if self.detected is not None:
+            self.detected.wait()
+        if not self.ksv:
+            raise OSError("rtmpdump-ksv not detected")
+
+    def check(self):
+        if self.detected is not None and self.detected.is_set() and \
+                not self.ksv:
+            sys.exit("rtmpdump-ksv not detected")
+
+    def start(self, stream, filename, output=None, first_byte=None):
+        # rtmpdump writes the file itself, the output reports the first byte
+        self.ready()
+        if output is None:
+            return Chaturbate.run_rtmpdump(stream, filename)
+        process = Chaturbate.run_rtmpdump(stream, '-',
+                                          stdout=subprocess.PIPE)
+        return PipedCapture(process, output)
+
+    def start_piped(self, stream, arguments):
+        self.ready()
+        process = Chaturbate.run_rtmpdump(stream, '-',
+                                          stdout=subprocess.PIPE)
+        consumer = subprocess.Popen(arguments, stdin=process.stdout)
+        # only the consumer should hold the read end of the pipe
+        process.stdout.close()
+        return Pipeline(process, consumer)
+
+    def probe(self, stream, timeout):
+        self.ready()
+        seconds = 2
+        process = Chaturbate.run_rtmpdump(
+            stream, '-', extra_argument="-B " + str(seconds),
+            stdout=subprocess.PIPE)
+
+        try:
+            ready = select.select([process.stdout], [], [], timeout)[0]
+            return bool(ready) and \
+                len(os.read(process.stdout.fileno(), 1)) > 0
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+
+
+class NativeBackend(CaptureBackend):
+    """
+    Records the streams in-process, see :mod:`native_capture`.
+
+    The stream URL is built from the ``url`` template of the ``[Capture]``
+    section, with the :class:`StreamInfo` fields as placeholders.
+    """
+    name = 'native'
+
+    def __init__(self, config):
+        import native_capture
+        self.native_capture = native_capture
+        self.url_template = config['capture-url']
+        self.timeout = config['capture-timeout']
+        self.engine = native_capture.NativeEngine()
+
+    def url(self, stream):
+        """
+        Builds the URL of a stream.
+
+        :param StreamInfo stream: The stream information.
+
+        :rtype: str
+        """
+        return self.url_template.format(**stream._asdict())
+
+    def start(self, stream, filename, output=None, first_byte=None):
+        return self.engine.capture(self.url(stream), filename, self.timeout,
+                                   output, first_byte)
+
+    def is_flv(self, stream):
+        return not self.native_capture.is_hls(self.url(stream))
+
+    def probe(self, stream, timeout):
+        return self.engine.probe(self.url(stream), timeout)
+
+
+CAPTURE_BACKENDS = {
+    RtmpdumpBackend.name: RtmpdumpBackend,
+    NativeBackend.name: NativeBackend,
+}
+"""Available engines to record the streams."""
+
+
+class Job(object):
+    """
+    A child process (or a pending probe) tracked by :class:`ProcessRegistry`.
+    """
+    __slots__ = ('id', 'type', 'model', 'process', 'state', 'time',
+                 'filename', 'source', 'destination', 'size', 'sampled',
+                 'rate', 'first_byte', 'grown', 'written', 'history',
+                 'stopping')
+    history_size = 120
+    """How many ``(time, written)`` samples a job keeps."""
+
+    def __init__(self, job_id, job_type, model, process=None, state=None,
+                 filename=None, source=None, destination=None):
+        self.id = job_id
+        self.type = job_type
+        self.model = model
+        self.process = process
+        self.state = state
+        self.time = int(time.time())
+        self.filename = filename
+        self.source = source
+        self.destination = destination
+        self.size = 0
+        self.sampled = None
+        self.rate = 0
+        self.first_byte = None
+        self.grown = None
+        self.written = 0
+        self.history = deque(maxlen=self.history_size)
+        self.stopping = None
+
+    def bitrate(self, window):
+        """
+        Returns the average write rate over the last ``window`` seconds.
+
+        When the samples don't go back that far, the average covers all of
+        them.
+
+        :param float window: Seconds.
+
+        :return: Bytes per second and the seconds actually covered.
+        :rtype: tuple
+        """
+        if len(self.history) < 2:
+            return 0, 0
+        end_time, end = self.history[-1]
+        start_time, start = self.history[0]
+        for point_time, written in reversed(self.history):
+            if end_time - point_time >= window:
+                start_time, start = point_time, written
+                break
+        span = end_time - start_time
+        if span <= 0:
+            return 0, 0
+        return (end - start) / span, span
+
+
+class ProcessRegistry(object):
+    """
+    Indexed collection of :class:`Job` objects.
+
+    Jobs are indexed by model and by type, and a counter is kept per state
+    (``probing``, ``capturing``, ``finalizing``, ``queued``,
+    ``transcoding``), so lookups, removals and status queries don't scan
+    every job.
+    """
+    PROBING = 'probing'
+    QUEUED = 'queued'
+    CAPTURING = 'capturing'
+    FINALIZING = 'finalizing'
+    TRANSCODING = 'transcoding'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.jobs = set()
+        self.models = {}
+        self.types = {}
+        self.states = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, job):
+        return job in self.jobs
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.jobs))
+
+    def add(self, job):
+        """
+        Adds a job to the registry.
+
+        :param Job job: The job.
+        """
+        with self.lock:
+            self.jobs.add(job)
+            self.models.setdefault(job.model, {}).setdefault(
+                job.type, set()).add(job)
+            self.types.setdefault(job.type, set()).add(job)
+            self.states[job.state] = self.states.get(job.state, 0) + 1
+
+    def remove(self, job):
+        """
+        Removes a job from the registry.
+
+        :param Job job: The job.
+
+        :return: False if the job was not in the registry.
+        :rtype: bool
+        """
+        with self.lock:
+            if job not in self.jobs:
+                return False
+            self.jobs.discard(job)
+            by_type = self.models[job.model]
+            by_type[job.type].discard(job)
+            if not by_type[job.type]:
+                del by_type[job.type]
+            if not by_type:
+                del self.models[job.model]
+            self.types[job.type].discard(job)
+            self.states[job.state] -= 1
+            return True
+
+    def set_state(self, job, state):
+        """
+        Moves a job to a new state.
+
+        :param Job job: The job.
+        :param str state: The new state.
+        """
+        with self.lock:
+            if job in self.jobs:
+                self.states[job.state] -= 1
+                self.states[state] = self.states.get(state, 0) + 1
+            job.state = state
+
+    def get(self, model, job_type):
+        """
+        Returns a job of the given type for a model.
+
+        :param str model: The model name.
+        :param str job_type: The job type.
+
+        :return: A job or None.
+        :rtype: Job
+        """
+        with self.lock:
+            jobs = self.models.get(model, {}).get(job_type)
+            if jobs:
+                return next(iter(jobs))
+        return None
+
+    def by_type(self, job_type):
+        """
+        Returns all the jobs of a type.
+
+        :param str job_type: The job type.
+
+        :rtype: list
+        """
+        with self.lock:
+            return list(self.types.get(job_type, ()))
+
+    def count(self, state):
+        """
+        Returns the number of jobs in a state.
+
+        :param str state: The state.
+
+        :rtype: int
+        """
+        return self.states.get(state, 0)
+
+
+class AdoptedProcess(object):
+    """
+    Popen-like wrapper for a child left behind by a previous run.
+
+    The process isn't our child, so its exit code is unknown and exit is
+    detected by polling.
+    """
+
+    def __init__(self, pid, argument=None):
+        self.pid = pid
+        self.argument = argument
+        self.returncode = None
+
+    @staticmethod
+    def is_alive(pid, argument=None):
+        """
+        Checks if a process exists, and optionally that it was started
+        with an argument (guards against reused pids).
+
+        :param int pid: Process id.
+        :param str argument: Argument expected in its command line.
+
+        :rtype: bool
+        """
+        try:
+            os.kill(pid, 0)
+        except OSError as error:
+            if error.errno != errno.EPERM:
+                return False
+
+        cmdline = '/proc/%d/cmdline' % pid
+        if argument is not None and os.path.exists(cmdline):
+            try:
+                with open(cmdline, 'rb') as f:
+                    arguments = f.read().split(b'\0')
+            except IOError:
+                return False
+            return argument.encode('utf-8') in arguments
+
+        return True
+
+    def poll(self):
+        """
+        :return: None while the process is running.
+        """
+        if self.returncode is None and \
+                not self.is_alive(self.pid, self.argument):
+            self.returncode = 0
+        return self.returncode
+
+    def wait(self):
+        """
+        Waits until the process exits.
+        """
+        while self.poll() is None:
+            time.sleep(1)
+        return self.returncode
+
+    def terminate(self):
+        """
+        Sends SIGTERM to the process.
+        """
+        try:
+            os.kill(self.pid, 15)
+        except OSError:
+            pass
+
+    kill = terminate
+
+
+class Journal(object):
+    """
+    Durable record of the capture and transcode jobs, kept in SQLite.
+
+    Every job is keyed by its file (the recording for captures, the source
+    for transcodes) and is removed once it is fully handled, so what is left
+    after a crash is exactly the unfinished work.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " path TEXT PRIMARY KEY,"
+            " type TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " destination TEXT,"
+            " pid INTEGER,"
+            " started INTEGER NOT NULL,"
+            " updated INTEGER NOT NULL)")
+        self.db.commit()
+
+    def record(self, path, job):
+        """
+        Inserts or updates a job.
+
+        :param str path: The file that identifies the job.
+        :param Job job: The job.
+        """
+        pid = job.process.pid if job.process is not None else None
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, job.type, job.model, job.state, job.destination, pid,
+                 job.time, int(time.time())))
+            self.db.commit()
+
+    def remove(self, path):
+        """
+        Removes a finished job.
+
+        :param str path: The file that identifies the job.
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE path = ?", (path,))
+            self.db.commit()
+
+    def jobs(self, job_type):
+        """
+        Returns the unfinished jobs of a type.
+
+        :param str job_type: The job type.
+
+        :return: ``(path, model, state, destination, pid, started)`` tuples.
+        :rtype: list
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, model, state, destination, pid, started "
+                "FROM jobs WHERE type = ? ORDER BY started",
+                (job_type,)).fetchall()
+
+
+class StorageManager(object):
+    """
+    Tracks the free space and the write rate of some directories with
+    ``statvfs``.
+
+    The write rate is how fast the free space shrank between two samples,
+    so it accounts for every writer on the filesystem.
+    """
+
+    def __init__(self, paths, min_free=0):
+        self.paths = paths
+        self.min_free = min_free
+        self.free = {}
+        self.rate = {}
+        self.sampled = {}
+
+    def sample(self):
+        """
+        Reads the free space of every directory.
+        """
+        if not hasattr(os, 'statvfs'):
+            return
+        now = time.time()
+        for path in self.paths:
+            try:
+                stat = os.statvfs(path)
+            except OSError:
+                continue
+            free = stat.f_bavail * stat.f_frsize
+            if path in self.free and now > self.sampled[path]:
+                self.rate[path] = max(
+                    0, (self.free[path] - free) / (now - self.sampled[path]))
+            self.free[path] = free
+            self.sampled[path] = now
+
+    def has_room(self, path, horizon=0):
+        """
+        Checks if a directory keeps the minimum free space.
+
+        :param str path: The directory.
+        :param float horizon: Seconds of writes at the current rate that
+                              must also fit.
+
+        :rtype: bool
+        """
+        if self.min_free <= 0 or path not in self.free:
+            return True
+        expected = self.free[path] - self.rate.get(path, 0) * horizon
+        return expected > self.min_free
+
+
+class RecordingIndex(object):
+    """
+    Size, age and model of the recordings in a directory.
+
+    The directory is listed once, afterwards the index is updated as
+    recordings are added and deleted, so the retention policies never walk
+    the directory.
+    """
+
+    def __init__(self, path, pattern):
+        self.path = path
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.models = {}
+        self.total = 0
+
+    def scan(self):
+        """
+        Indexes the recordings already in the directory, oldest first.
+        """
+        found = []
+        for name in os.listdir(self.path):
+            match = self.pattern.match(name)
+            if match is None:
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, filename, match.group(1),
+                          stat.st_size))
+        for mtime, filename, model, size in sorted(found):
+            self.put(filename, model, size, mtime)
+
+    def put(self, filename, model, size, mtime):
+        with self.lock:
+            self.pop(filename)
+            self.files[filename] = (model, size, mtime)
+            self.models[model] = self.models.get(model, 0) + size
+            self.total += size
+
+    def pop(self, filename):
+        entry = self.files.pop(filename, None)
+        if entry is not None:
+            self.models[entry[0]] -= entry[1]
+            if self.models[entry[0]] <= 0:
+                del self.models[entry[0]]
+            self.total -= entry[1]
+
+    def add(self, filename, model):
+        """
+        Indexes a new recording.
+
+        :param str filename: The recording.
+        :param str model: The model name.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return
+        self.put(filename, model, stat.st_size, stat.st_mtime)
+
+    def discard(self, filename):
+        """
+        Removes a recording from the index.
+
+        :param str filename: The recording.
+        """
+        with self.lock:
+            self.pop(filename)
+
+    def expired(self, max_age=0, max_size=0, quota=0, keep=()):
+        """
+        Picks the recordings to delete, oldest first, so the rest respects
+        the retention policies. A limit of 0 disables its policy.
+
+        :param float max_age: Maximum age in seconds.
+        :param int max_size: Maximum size of all the recordings.
+        :param int quota: Maximum size of the recordings of each model.
+        :param keep: Recordings that can't be deleted.
+
+        :rtype: list
+        """
+        now = time.time()
+        with self.lock:
+            total = self.total
+            models = dict(self.models)
+            victims = []
+            for filename, (model, size, mtime) in self.files.items():
+                if filename in keep:
+                    continue
+                if (max_age and now - mtime > max_age) or \
+                        (max_size and total > max_size) or \
+                        (quota and models[model] > quota):
+                    victims.append(filename)
+                    total -= size
+                    models[model] -= size
+        return victims
+
+
+class HashRing(object):
+    """
+    Consistent hashing of model names over the nodes of a cluster.
+
+    Every node is placed at ``replicas`` points of the ring, so when a node
+    joins or leaves only its own share of the models moves.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.points = sorted((self.hash('%s#%d' % (node, i)), node)
+                             for node in nodes for i in range(replicas))
+        self.keys = [point for point, _ in self.points]
+
+    @staticmethod
+    def hash(key):
+        """
+        :rtype: int
+        """
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def node(self, key):
+        """
+        Returns the node that owns a key.
+
+        :param str key: The model name.
+
+        :return: The node name, or None if the ring is empty.
+        :rtype: str
+        """
+        if not self.points:
+            return None
+        i = bisect.bisect(self.keys, self.hash(key)) % len(self.points)
+        return self.points[i][1]
+
+
+class Coordinator(object):
+    """
+    Shared state of a cluster of recorders, kept in a SQLite database that
+    every node can open, SQLite's file locks serialize the nodes.
+
+    Nodes send heartbeats, publish the online models of their own followed
+    list and hold a lease on every show they record, so two nodes never
+    record the same show. Leases and heartbeats expire after ``lease``
+    seconds, the clocks of the nodes are expected to be in sync.
+    """
 
-import subprocess
-import re
-import urllib
-import time
-import json
-from datetime import datetime, timedelta
-import logging
-import requests
-from bs4 import BeautifulSoup
+    def __init__(self, filename, node, lease=180):
+        self.node = node
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=30,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        with self.lock:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS nodes ("
+                " name TEXT PRIMARY KEY,"
+                " seen REAL NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS online ("
+                " model TEXT NOT NULL,"
+                " node TEXT NOT NULL,"
+                " PRIMARY KEY (model, node))")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " model TEXT PRIMARY KEY,"
+                " node TEXT NOT NULL,"
+                " expires REAL NOT NULL)")
+
+    def transaction(self, function, *args):
+        """
+        Runs a function inside a write transaction.
+
+        :return: What the function returned.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def heartbeat(self):
+        """
+        Tells the other nodes this one is alive.
+        """
+        self.transaction(
+            self.db.execute, "INSERT OR REPLACE INTO nodes VALUES (?, ?)",
+            (self.node, time.time()))
+
+    def nodes(self):
+        """
+        Returns the live nodes.
+
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name FROM nodes WHERE seen > ? ORDER BY name",
+                (time.time() - self.lease,)).fetchall()
+        return [row[0] for row in rows]
+
+    def publish(self, models):
+        """
+        Replaces the online models found by this node.
+
+        :param list models: The online models.
+        """
+        def replace():
+            self.db.execute("DELETE FROM online WHERE node = ?", (self.node,))
+            self.db.executemany("INSERT OR IGNORE INTO online VALUES (?, ?)",
+                                [(model, self.node) for model in models])
+        self.transaction(replace)
+
+    def online(self):
+        """
+        Returns the online models published by the live nodes.
+
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT DISTINCT model FROM online JOIN nodes"
+                " ON online.node = nodes.name WHERE nodes.seen > ?"
+                " ORDER BY model", (time.time() - self.lease,)).fetchall()
+        return [row[0] for row in rows]
+
+    def take(self, model, now):
+        row = self.db.execute("SELECT node, expires FROM leases "
+                              "WHERE model = ?", (model,)).fetchone()
+        if row is not None and row[0] != self.node and row[1] > now:
+            return False
+        self.db.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                        (model, self.node, now + self.lease))
+        return True
+
+    def claim(self, model):
+        """
+        Takes the lease of a show, unless another node holds it.
+
+        :param str model: The model name.
+
+        :rtype: bool
+        """
+        return self.transaction(self.take, model, time.time())
+
+    def renew(self, models):
+        """
+        Extends the leases of the shows being recorded.
+
+        :param list models: The model names.
+
+        :return: The models whose lease was taken by another node.
+        :rtype: list
+        """
+        def renew_all(now):
+            return [model for model in models if not self.take(model, now)]
+        return self.transaction(renew_all, time.time())
+
+    def release(self, model):
+        """
+        Gives up the lease of a show.
+
+        :param str model: The model name.
+        """
+        self.transaction(
+            self.db.execute,
+            "DELETE FROM leases WHERE model = ? AND node = ?",
+            (model, self.node))
+
+
+class Scheduler(object):
+    """
+    Decides when the next cycle and the fast re-checks run.
+
+    Cycles run at a fixed rate, a cycle starts ``interval`` seconds after
+    the previous one started no matter how long it took, and ticks missed
+    by more than an interval are skipped. The interval adapts: it is halved
+    after a cycle with changes and grows by a quarter after a quiet one,
+    between ``min_interval`` and ``max_interval`` (the base interval during
+    peak hours).
+
+    Models that changed recently are re-checked every ``recheck`` seconds
+    for ``window`` seconds, between the cycles.
+    """
+
+    def __init__(self, interval=60, min_interval=20, max_interval=300,
+                 peak_hours=(), recheck=15, window=300):
+        self.base = interval
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.peak_hours = peak_hours
+        self.recheck = recheck
+        self.window = window
+        self.deadline = time.time()
+        self.lag = 0
+        self.changes = 0
+        self.lock = threading.Lock()
+        self.rechecks = {}
+
+    @staticmethod
+    def parse_hours(text):
+        """
+        Parses hour ranges like ``8-10,18-2``, the end hour is excluded.
+
+        :param str text: The ranges.
+
+        :rtype: set
+        """
+        hours = set()
+        for part in text.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            start, _, end = part.partition('-')
+            start = int(start) % 24
+            end = (int(end) if end else start + 1) % 24
+            hours.add(start)
+            hour = (start + 1) % 24
+            while hour != end:
+                hours.add(hour)
+                hour = (hour + 1) % 24
+        return hours
+
+    def due(self):
+        """
+        Checks if it is time for a cycle.
+
+        :rtype: bool
+        """
+        return time.time() >= self.deadline
+
+    def start_cycle(self):
+        """
+        Marks the start of a cycle and measures how late it is.
+        """
+        now = time.time()
+        self.lag = max(0, now - self.deadline)
+        if self.lag > self.interval:
+            self.deadline = now
+
+    def finish_cycle(self):
+        """
+        Adapts the interval to the changes seen and schedules the next
+        cycle.
+        """
+        if self.changes > 0:
+            interval = self.interval / 2.0
+        else:
+            interval = self.interval * 1.25
+        upper = self.max_interval
+        if datetime.now().hour in self.peak_hours:
+            upper = min(upper, self.base)
+        self.interval = max(self.min_interval, min(upper, interval))
+        self.changes = 0
+        self.deadline += self.interval
+
+    def limit(self, upper):
+        """
+        Caps every interval, the cluster leases must be renewed in time.
+
+        :param float upper: The longest interval.
+        """
+        self.max_interval = min(self.max_interval, upper)
+        self.min_interval = min(self.min_interval, upper)
+        self.base = min(self.base, upper)
+        self.interval = min(self.interval, upper)
+
+    def watch(self, models, others=0):
+        """
+        Starts the fast re-checks of models that came online.
+
+        :param list models: The model names.
+        :param int others: Other changes seen, like models that went
+                           offline, they only shorten the interval.
+        """
+        now = time.time()
+        with self.lock:
+            self.changes += len(models) + others
+            if self.recheck <= 0:
+                return
+            for model in models:
+                self.rechecks[model] = [now + self.recheck, now + self.window]
+
+    def due_rechecks(self):
+        """
+        Returns the models to re-check now and schedules their next one.
+
+        :rtype: list
+        """
+        now = time.time()
+        models = []
+        with self.lock:
+            for model, times in list(self.rechecks.items()):
+                if times[1] < now:
+                    del self.rechecks[model]
+                elif times[0] <= now:
+                    times[0] = now + self.recheck
+                    models.append(model)
+        return sorted(models)
+
+    def next_recheck(self):
+        """
+        Returns when the next re-check is due.
+
+        :return: A timestamp, or None if no model is watched.
+        :rtype: float
+        """
+        with self.lock:
+            if not self.rechecks:
+                return None
+            return min(times[0] for times in self.rechecks.values())
+
+    def sleep(self):
+        """
+        Sleeps until the next cycle or re-check is due.
+        """
+        wake = self.deadline
+        recheck = self.next_recheck()
+        if recheck is not None:
+            wake = min(wake, recheck)
+        delay = wake - time.time()
+        if delay > 0:
+            time.sleep(delay)
 
 
 class Chaturbate(object):
@@ -39,8 +2157,8 @@ class Chaturbate(object):
     agent = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36' \
                  '(KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36'
     """User agent to be used in the requests."""
-    processes = []
-    """A list with all the processes."""
+    processes = None
+    """A :class:`ProcessRegistry` with all the processes."""
     request = None
     """An instance of the requests class."""
     log = None
@@ -53,18 +2171,174 @@ class Chaturbate(object):
         'debug': None,
         'ffmpeg': None,
         'ffmpeg-flags': None,
+        'workers': 8,
+        'parser': 'auto',
+        'probe-timeout': 5,
+        'cache-size': 1000,
+        'cache-ttl': 300,
+        'cache-backoff': 60,
+        'cache-max-backoff': 3600,
+        'ffmpeg-workers': 2,
+        'ffmpeg-order': 'fifo',
+        'ffmpeg-nice': 10,
+        'ffmpeg-ionice': '',
+        'journal': 'journal.db',
+        'metrics-port': 0,
+        'metrics-file': '',
+        'http-pool': 10,
+        'http-connect-timeout': 5,
+        'http-read-timeout': 15,
+        'http-backoff': 1,
+        'http-max-backoff': 60,
+        'http-retry-ratio': 0.2,
+        'http-breaker-threshold': 5,
+        'http-breaker-cooldown': 60,
+        'capture-backend': 'rtmpdump',
+        'capture-url': 'https://{server}/live-hls/amlst:{room}/playlist.m3u8',
+        'capture-timeout': 30,
+        'segment-duration': 0,
+        'segment-size': 0,
+        'finalize-verify': 'true',
+        'ffmpeg-live': 'false',
+        'storage-min-free': 1024,
+        'retention-max-age': 0,
+        'retention-max-size': 0,
+        'retention-model-quota': 0,
+        'cluster-node': '',
+        'cluster-coordinator': 'cluster.db',
+        'cluster-lease': 180,
+        'cluster-replicas': 100,
+        'scheduler-interval': 60,
+        'scheduler-min-interval': 20,
+        'scheduler-max-interval': 300,
+        'scheduler-peak-hours': '',
+        'scheduler-recheck': 15,
+        'scheduler-recheck-window': 300,
+        'health-stall': 60,
+        'health-min-rate': 0,
+        'health-window': 300,
+        'log-level': '',
+        'log-format': 'text',
+        'log-file': '',
+        'log-async': 'false',
+        'log-recordings': 'auto',
+        'startup-fast': 'false',
     }
     """Configuration"""
+    cycle_time = None
+    """Duration in seconds of the last :meth:`do_cycle`."""
+    interval = 60
+    """Seconds between cycles, adapted by the :class:`Scheduler`."""
+    base_url = 'https://chaturbate.com/'
+    """Address of the site, can point to a stub server for testing."""
+    cookie_fn = 'cookie.txt'
+    """File where the session cookies are kept between runs."""
+    tools_fn = 'tools.json'
+    """File where the detected external programs are cached."""
+    warmup = None
+    """The thread doing the first followed cams fetch in fast start mode."""
+    logged_re = re.compile(r'<div[^>]+id=["\']user_information["\']')
+    """Matches the element that is only present when logged in."""
+    capture_re = re.compile(
+        r'^Chaturbate_(.+)_\d{4}-\d\d-\d\dT\d{6}(?:-\d+)?\.(?:flv|mp4)$')
+    """Matches the name of the files created by :meth:`capture`."""
+    journal = None
+    """A :class:`Journal`, or None if it is disabled."""
+    storage = None
+    """A :class:`StorageManager` watching both directories."""
+    index = None
+    """A :class:`RecordingIndex` of the completed path."""
+    cluster = None
+    """A :class:`Coordinator`, or None when running alone."""
+    ring = None
+    """The :class:`HashRing` of the last cycle, in a cluster."""
+    scheduler = None
+    """The :class:`Scheduler` of the cycles and the fast re-checks."""
+    log_format = "%(asctime)s %(levelname)s %(message)s"
+    """Format of the text log lines."""
+    log_listener = None
+    """The QueueListener writing the log in the background, if enabled."""
+    summary_threshold = 10
+    """Above this many captures, ``auto`` logs one summary per cycle."""
+    page_re = re.compile(r'href=["\'][^"\']*[?&]page=(\d+)')
+    """Matches the links to the other pages of the followed cams list."""
 
     def __init__(self):
         """
         Configures logging, reads configuration
         """
-        self.detect_rtmpdump()
-
         # create a requests object with sessions
         self.request = requests.Session()
 
+        self.processes = ProcessRegistry()
+        self.login_lock = threading.Lock()
+        self.counters = EventCounter()
+        self.transcodes = []
+        self.transcode_ids = itertools.count(1)
+        self.transcode_lock = threading.Lock()
+        self.moves = queue.Queue()
+        self.mover = None
+        self.segments = queue.Queue()
+        self.segmenter = None
+        self.segment_lock = threading.Lock()
+        self.transcodes_paused = False
+        self.pages = {}
+        self.followed = {}
+        self.sample_lock = threading.Lock()
+        self.saved_cookies = None
+        self.cookie_lock = threading.Lock()
+
+        self.metrics = Metrics()
+        self.metrics.histogram('chaturbate_request_seconds',
+                               'Duration of the page requests.')
+        self.metrics.histogram('chaturbate_parse_seconds',
+                               'Time to parse the followed cams page.')
+        self.metrics.histogram('chaturbate_probe_seconds',
+                               'Duration of the private show probes.')
+        self.metrics.histogram('chaturbate_first_byte_seconds',
+                               'Time until a capture writes its first byte.')
+        self.metrics.gauge('chaturbate_cycle_seconds',
+                           'Duration of the last cycle.')
+        self.metrics.gauge('chaturbate_interval_seconds',
+                           'Seconds between cycles.')
+        self.metrics.gauge('chaturbate_capture_restarts_total',
+                           'Captures restarted after a stall or a low '
+                           'bitrate.', 'counter')
+        self.metrics.gauge('chaturbate_scheduler_lag_seconds',
+                           'How late the last cycle started.')
+        self.metrics.gauge('chaturbate_rechecks_total',
+                           'Fast re-checks of models that changed.',
+                           'counter')
+        self.metrics.gauge('chaturbate_captures', 'Active captures.')
+        self.metrics.gauge('chaturbate_transcodes', 'Running transcodes.')
+        self.metrics.gauge('chaturbate_transcodes_queued',
+                           'Transcodes waiting for a worker.')
+        self.metrics.gauge('chaturbate_capture_bytes_per_second',
+                           'Write rate of each recording.')
+        self.metrics.gauge('chaturbate_http_requests_total',
+                           'Requests sent, retries included.', 'counter')
+        self.metrics.gauge('chaturbate_http_retries_total',
+                           'Requests retried after a failure.', 'counter')
+        self.metrics.gauge('chaturbate_http_budget_exhausted_total',
+                           'Retries refused by the retry budget.', 'counter')
+        self.metrics.gauge('chaturbate_http_breaker_open',
+                           '1 while the circuit breaker is open.')
+        self.metrics.gauge('chaturbate_http_connections_total',
+                           'Connections opened by the pool.', 'counter')
+        self.metrics.gauge('chaturbate_followed_pages_unchanged_total',
+                           'Followed cams pages that were not parsed '
+                           'again.', 'counter')
+        self.metrics.gauge('chaturbate_disk_free_bytes',
+                           'Free space of each directory.', label='path')
+        self.metrics.gauge('chaturbate_disk_write_bytes_per_second',
+                           'How fast the free space of each directory '
+                           'shrinks.', label='path')
+        self.metrics.gauge('chaturbate_completed_bytes',
+                           'Size of the recordings in the completed path.')
+        self.metrics.gauge('chaturbate_retention_deleted_total',
+                           'Recordings deleted by the retention policies.',
+                           'counter')
+
         # configure logging
         logging.getLogger("requests").setLevel(logging.WARNING)
         logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -72,10 +2346,10 @@ class Chaturbate(object):
         self.log.setLevel(logging.DEBUG)
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s",
-                                      "%Y-%m-%d %H:%M:%S")
+        formatter = logging.Formatter(self.log_format, "%Y-%m-%d %H:%M:%S")
         console_handler.setFormatter(formatter)
         self.log.addHandler(console_handler)
+        self.log_handler = console_handler
 
         # read configuration
         config_fn = "config.ini"
@@ -96,11 +2370,103 @@ class Chaturbate(object):
 
         self.config['ffmpeg'] = config.get('FFmpeg', 'enable')
         self.config['ffmpeg-flags'] = config.get('FFmpeg', 'options')
+        self.config['ffmpeg-workers'] = int(self.get_option(
+            config, 'FFmpeg', 'workers', self.config['ffmpeg-workers']))
+        self.config['ffmpeg-order'] = self.get_option(
+            config, 'FFmpeg', 'order', self.config['ffmpeg-order'])
+        self.config['ffmpeg-nice'] = int(self.get_option(
+            config, 'FFmpeg', 'nice', self.config['ffmpeg-nice']))
+        self.config['ffmpeg-ionice'] = self.get_option(
+            config, 'FFmpeg', 'ionice', self.config['ffmpeg-ionice'])
+        self.config['ffmpeg-live'] = self.get_option(
+            config, 'FFmpeg', 'live', self.config['ffmpeg-live'])
 
-        try:
-            self.config['debug'] = config.get('Debug', 'enable')
-        except ConfigParser.NoSectionError:
-            pass
+        self.config['debug'] = self.get_option(config, 'Debug', 'enable',
+                                               self.config['debug'])
+        self.configure_logging(config)
+        self.config['startup-fast'] = self.get_option(
+            config, 'Startup', 'fast', self.config['startup-fast'])
+        self.config['workers'] = int(self.get_option(
+            config, 'Workers', 'probes', self.config['workers']))
+
+        self.config['parser'] = self.get_option(
+            config, 'Parser', 'backend', self.config['parser'])
+        if self.config['parser'] == 'auto':
+            self.config['parser'] = 'lxml' if etree else 'html.parser'
+        if self.config['parser'] not in FOLLOWED_PARSERS:
+            self.log.error("Unknown parser backend %s", self.config['parser'])
+            sys.exit(1)
+
+        self.config['probe-timeout'] = float(self.get_option(
+            config, 'Probe', 'timeout', self.config['probe-timeout']))
+
+        self.config['capture-backend'] = self.get_option(
+            config, 'Capture', 'backend', self.config['capture-backend'])
+        self.config['capture-url'] = self.get_option(
+            config, 'Capture', 'url', self.config['capture-url'])
+        self.config['capture-timeout'] = float(self.get_option(
+            config, 'Capture', 'timeout', self.config['capture-timeout']))
+        self.config['segment-duration'] = float(self.get_option(
+            config, 'Capture', 'segment-duration',
+            self.config['segment-duration']))
+        self.config['segment-size'] = int(self.get_option(
+            config, 'Capture', 'segment-size',
+            self.config['segment-size'])) * 1024 * 1024
+        self.config['finalize-verify'] = self.get_option(
+            config, 'Finalize', 'verify', self.config['finalize-verify'])
+        for option in ('stall', 'min-rate', 'window'):
+            key = 'health-' + option
+            self.config[key] = float(self.get_option(
+                config, 'Health', option, self.config[key]))
+        self.config['health-min-rate'] *= 1024
+
+        if self.config['capture-backend'] not in CAPTURE_BACKENDS:
+            self.log.error("Unknown capture backend %s",
+                           self.config['capture-backend'])
+            sys.exit(1)
+        self.backend = CAPTURE_BACKENDS[self.config['capture-backend']](
+            self.config)
+        if self.config['ffmpeg-live'] == 'true' and \
+                self.config['capture-backend'] != 'rtmpdump':
+            self.log.warning("FFmpeg live mode needs the rtmpdump backend")
+            self.config['ffmpeg-live'] = 'false'
+        for option in ('size', 'ttl', 'backoff', 'max-backoff'):
+            key = 'cache-' + option
+            self.config[key] = float(self.get_option(
+                config, 'Cache', option, self.config[key]))
+
+        for option in ('pool', 'connect-timeout', 'read-timeout', 'backoff',
+                       'max-backoff', 'retry-ratio', 'breaker-threshold',
+                       'breaker-cooldown'):
+            key = 'http-' + option
+            self.config[key] = float(self.get_option(
+                config, 'HTTP', option, self.config[key]))
+
+        # keep enough pooled connections for every probe worker
+        pool = max(int(self.config['http-pool']), self.config['workers'])
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool,
+                                                pool_maxsize=pool)
+        self.request.mount('https://', adapter)
+        self.request.mount('http://', adapter)
+        self.adapter = adapter
+        self.timeout = (self.config['http-connect-timeout'],
+                        self.config['http-read-timeout'])
+        self.retry_budget = RetryBudget(
+            ratio=self.config['http-retry-ratio'],
+            capacity=max(int(pool), 10))
+        self.breaker = CircuitBreaker(
+            threshold=int(self.config['http-breaker-threshold']),
+            cooldown=self.config['http-breaker-cooldown'])
+
+        self.discovery = DiscoveryCache(
+            size=int(self.config['cache-size']),
+            ttl=self.config['cache-ttl'],
+            backoff=self.config['cache-backoff'],
+            max_backoff=self.config['cache-max-backoff'])
+
+        self.load_cookies()
+        if self.config['startup-fast'] == 'true':
+            self.warm_up()
 
         # Create directories
         self.config['capturing_path'] = config.get('Directories', 'capturing')
@@ -109,10 +2475,140 @@ class Chaturbate(object):
         self.test_path(self.config['capturing_path'])
         self.test_path(self.config['completed_path'])
 
+        self.config['storage-min-free'] = int(self.get_option(
+            config, 'Storage', 'min-free',
+            self.config['storage-min-free'])) * 1024 * 1024
+        self.config['retention-max-age'] = float(self.get_option(
+            config, 'Retention', 'max-age',
+            self.config['retention-max-age'])) * 24 * 3600
+        for option in ('max-size', 'model-quota'):
+            key = 'retention-' + option
+            self.config[key] = int(float(self.get_option(
+                config, 'Retention', option, self.config[key])) * 1024 ** 3)
+
+        self.storage = StorageManager(
+            [self.config['capturing_path'], self.config['completed_path']],
+            self.config['storage-min-free'])
+        self.storage.sample()
+        self.index = RecordingIndex(self.config['completed_path'],
+                                    self.capture_re)
+        self.index.scan()
+
+        self.config['metrics-port'] = int(self.get_option(
+            config, 'Metrics', 'port', self.config['metrics-port']))
+        self.config['metrics-file'] = self.get_option(
+            config, 'Metrics', 'file', self.config['metrics-file'])
+        if self.config['metrics-port'] > 0:
+            self.serve_metrics(self.config['metrics-port'])
+
+        for option in ('interval', 'min-interval', 'max-interval', 'recheck',
+                       'recheck-window'):
+            key = 'scheduler-' + option
+            self.config[key] = float(self.get_option(
+                config, 'Scheduler', option, self.config[key]))
+        self.config['scheduler-peak-hours'] = self.get_option(
+            config, 'Scheduler', 'peak-hours',
+            self.config['scheduler-peak-hours'])
+        self.scheduler = Scheduler(
+            self.config['scheduler-interval'],
+            self.config['scheduler-min-interval'],
+            self.config['scheduler-max-interval'],
+            Scheduler.parse_hours(self.config['scheduler-peak-hours']),
+            self.config['scheduler-recheck'],
+            self.config['scheduler-recheck-window'])
+        self.interval = self.scheduler.interval
+
+        for option in ('node', 'coordinator', 'lease', 'replicas'):
+            key = 'cluster-' + option
+            self.config[key] = self.get_option(
+                config, 'Cluster', option, self.config[key])
+        self.config['cluster-lease'] = float(self.config['cluster-lease'])
+        self.config['cluster-replicas'] = int(
+            self.config['cluster-replicas'])
+        if self.config['cluster-node']:
+            self.cluster = Coordinator(self.config['cluster-coordinator'],
+                                       self.config['cluster-node'],
+                                       self.config['cluster-lease'])
+            # the first cycle must already find this node in the ring
+            self.cluster.heartbeat()
+            # the leases are renewed once per cycle
+            self.scheduler.limit(self.config['cluster-lease'] / 2)
+            self.interval = self.scheduler.interval
+
+        self.config['journal'] = self.get_option(
+            config, 'Journal', 'path', self.config['journal'])
+        if self.config['journal']:
+            self.journal = Journal(self.config['journal'])
+            self.recover()
+
+    def configure_logging(self, config):
+        """
+        Applies the ``[Log]`` section.
+
+        The level defaults to ``debug`` when debugging is enabled and to
+        ``info`` otherwise. The format is ``text`` or ``json`` (one object
+        per line), written to stderr or to ``file``. With ``async``, records
+        are queued and written by a background thread, so the recorder
+        never waits for the console.
+
+        :param config: A ConfigParser instance.
+        """
+        for option in ('level', 'format', 'file', 'async', 'recordings'):
+            key = 'log-' + option
+            self.config[key] = self.get_option(config, 'Log', option,
+                                               self.config[key])
+        level = self.config['log-level'] or \
+            ('debug' if self.config['debug'] == 'true' else 'info')
+        self.log.setLevel(getattr(logging, level.upper(), logging.INFO))
+
+        if self.config['log-file']:
+            handler = logging.FileHandler(self.config['log-file'])
+        else:
+            handler = logging.StreamHandler()
+        if self.config['log-format'] == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(self.log_format,
+                                                   "%Y-%m-%d %H:%M:%S"))
+
+        if self.config['log-async'] == 'true':
+            if not hasattr(logging.handlers, 'QueueListener'):
+                self.log.warning("Asynchronous logging needs Python 3.2+")
+            else:
+                records = queue.Queue()
+                self.log_listener = logging.handlers.QueueListener(records,
+                                                                   handler)
+                self.log_listener.start()
+                atexit.register(self.log_listener.stop)
+                handler = logging.handlers.QueueHandler(records)
+
+        self.log.removeHandler(self.log_handler)
+        self.log.addHandler(handler)
+        self.log_handler = handler
+
+    @staticmethod
+    def get_option(config, section, option, default=None):
+        """
+        Reads an optional value from the configuration.
+
+        :param config: A ConfigParser instance.
+        :param str section: Section name.
+        :param str option: Option name.
+        :param default: Value to return if the option is missing.
+
+        :return: The option value or the default.
+        """
+        if config.has_option(section, option):
+            return config.get(section, option)
+        return default
+
     def test_path(self, path):
         """
         Tests if a path exists and if its possible to write to it.
 
+        In fast start mode the permissions are checked instead of writing
+        a test file.
+
         :param path: Path to test.
         """
         if os.path.isdir(path) is False:
@@ -122,6 +2618,12 @@ class Chaturbate(object):
                 self.log.error("Unable to create %s", path)
                 sys.exit(1)
 
+        if self.config['startup-fast'] == 'true':
+            if not os.access(path, os.W_OK | os.X_OK):
+                self.log.error("Unable to write to %s", path)
+                sys.exit(1)
+            return
+
         filename = "test-perm.txt"
         filename = os.path.join(path, filename)
         try:
@@ -132,22 +2634,57 @@ class Chaturbate(object):
             self.log.error("Unable to write to %s", filename)
             sys.exit(1)
 
-    @staticmethod
-    def detect_rtmpdump():
+    @classmethod
+    def detect_rtmpdump(cls):
+        """
+        Checks if rtmpdump-ksv is installed, exits if it isn't.
+        """
+        if not cls.check_rtmpdump():
+            sys.exit("rtmpdump-ksv not detected")
+
+    @classmethod
+    def check_rtmpdump(cls):
         """
-        Checks if rtmpdump-ksv is installed
+        Checks if the rtmpdump in the PATH is rtmpdump-ksv.
+
+        The answer is cached in :data:`tools_fn` with the path and mtime
+        of the binary, rtmpdump only runs again when it changed.
 
         :rtype: bool
         """
+        path = which("rtmpdump")
+        if path is None:
+            return False
+        mtime = os.stat(path).st_mtime
+
+        tools = {}
+        try:
+            with open(cls.tools_fn) as f:
+                tools = json.load(f)
+        except (IOError, ValueError):
+            pass
+        cached = tools.get('rtmpdump')
+        if cached is not None and cached.get('path') == path and \
+                cached.get('mtime') == mtime:
+            return cached['ksv']
+
         arguments = [
-            "rtmpdump",
+            path,
             "--help",
         ]
 
         output = subprocess.check_output(arguments, stderr=subprocess.STDOUT)
 
-        if b'--weeb' not in output:
-            sys.exit("rtmpdump-ksv not detected")
+        tools['rtmpdump'] = {'path': path, 'mtime': mtime,
+                             'ksv': b'--weeb' in output}
+        try:
+            temp_fn = cls.tools_fn + '.tmp'
+            with open(temp_fn, 'w') as f:
+                json.dump(tools, f)
+            os.rename(temp_fn, cls.tools_fn)
+        except (IOError, OSError):
+            pass
+        return tools['rtmpdump']['ksv']
 
 
     @staticmethod
@@ -170,8 +2707,8 @@ class Chaturbate(object):
         f = ('%.2f' % size).rstrip('0').rstrip('.')
         return '%s %s' % (f, suffixes[i])
 
-    @staticmethod
-    def is_logged(html):
+    @classmethod
+    def is_logged(cls, html):
         """
         Checks if you're currently logged in.
 
@@ -179,104 +2716,333 @@ class Chaturbate(object):
 
         :rtype: bool
         """
-        soup = BeautifulSoup(html, "html.parser")
+        return cls.logged_re.search(html) is not None
 
-        if soup.find('div', {'id': 'user_information'}) is None:
-            return False
-        return True
+    def load_cookies(self):
+        """
+        Loads the saved cookies into the session.
+        """
+        if not os.path.isfile(self.cookie_fn):
+            return
+
+        try:
+            with open(self.cookie_fn, 'r') as f:
+                cookies = json.load(f)
+        except ValueError:
+            self.log.warning("Ignoring invalid %s", self.cookie_fn)
+            return
+
+        self.request.cookies.update(cookies)
+        self.saved_cookies = cookies
+        self.counters.hit('cookie_reload')
+
+    def save_cookies(self):
+        """
+        Saves the session cookies, if they changed since the last save.
+
+        The file is replaced atomically so a crash never leaves it truncated,
+        and the probe threads save one at a time.
+        """
+        with self.cookie_lock:
+            cookies = requests.utils.dict_from_cookiejar(self.request.cookies)
+            if cookies == self.saved_cookies:
+                return
+
+            fd, temp_fn = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.cookie_fn)),
+                prefix=os.path.basename(self.cookie_fn) + '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(cookies, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(temp_fn, self.cookie_fn)
+            except BaseException:
+                os.remove(temp_fn)
+                raise
+            self.saved_cookies = cookies
 
     @staticmethod
-    def run_rtmpdump(flv_info, output_filename, extra_argument=""):
+    def run_rtmpdump(flv_info, output_filename, extra_argument="",
+                     stdout=None):
         """
         Runs rtmpdump with the provided parameters.
 
-        :param list flv_info: A list with all the flv variables.
-        :param str output_filename: Filename where to output the stream.
-        :param str extra_argument: Extra argument to pass to rtmpdump.
+        :param StreamInfo flv_info: The stream information.
+        :param str output_filename: Filename where to output the stream,
+                                    ``-`` for stdout.
+        :param str extra_argument: Extra argument to pass to rtmpdump.
+        :param stdout: Passed to Popen, use PIPE to read the stream.
+
+        :return: A Popen object (process).
+        :rtype: Popen
+        """
+        if sys.version_info[0] < 3:
+            unquote = urllib.unquote(flv_info.password)
+        else:
+            unquote = urllib.parse.unquote(flv_info.password)
+
+        arguments = [
+            "rtmpdump",
+            "--quiet",
+            "--live",
+            extra_argument,
+            "--rtmp", "rtmp://" + flv_info.server + "/live-edge",
+            "--pageUrl", "http://chaturbate.com/" + flv_info.room,
+            "--conn", "S:" + flv_info.username,
+            "--conn", "S:" + flv_info.room,
+            "--conn", "S:2.649",
+            "--conn", "S:" + unquote,
+            "--token", "m9z#$dO0qe34Rxe@sMYxx",
+            "--playpath", "playpath",
+            "--flv", output_filename
+        ]
+
+        return subprocess.Popen(arguments, stdout=stdout)
+
+    @staticmethod
+    def get_process_stats(process_info, file_size=None):
+        """
+        Generates various info about the file being captured.
+
+        :param Job process_info: Information about the rtmpdump process.
+        :param int file_size: Size of the file, if it is already known.
+
+        :return: Statistics about the recording.
+        :rtype: dict
+        """
+        if file_size is None:
+            file_size = int(os.path.getsize(process_info.filename))
+        return {
+            'file_size': file_size,
+            'formatted_file_size': Chaturbate.get_human_size(file_size),
+            'started_at': time.strftime(
+                "%H:%M", time.localtime(process_info.time)),
+            'recording_time': str(
+                timedelta(seconds=int(time.time()) - process_info.time))
+        }
+
+    def make_request(self, url):
+        """
+        Does a GET request and returns the HTML content.
+
+        :param str url: The URL to open.
+
+        :return: The HTML source of the requested URL.
+        :rtype: str
+
+        :raises RequestError: If the page couldn't be fetched.
+        """
+        return self.get(url).text
+
+    def get(self, url, headers=None):
+        """
+        Does a GET request, logging in again if the session expired.
+
+        :param str url: The URL to open.
+        :param dict headers: Extra request headers.
+
+        :return: The response, its status is 200 or 304.
+        :rtype: requests.Response
+
+        :raises RequestError: If the page couldn't be fetched.
+        """
+        while True:
+            logins = self.counters.total('login')
+            request = self.send('get', url, headers=headers)
+
+            if request.status_code == 304:
+                break
+
+            if self.is_logged(request.text) is False:
+                self.log.warning("Not logged in")
+                with self.login_lock:
+                    # another thread may have logged in meanwhile
+                    if self.counters.total('login') == logins:
+                        self.login()
+                continue
+
+            break
+
+        self.save_cookies()
+
+        return request
+
+    def send(self, method, url, **kwargs):
+        """
+        Does a request within the retry policy.
+
+        Failed requests are retried with jittered exponential backoff while
+        the retry budget allows it. Too many consecutive failures open the
+        circuit breaker, and requests fail right away until it cools down.
+
+        :param str method: The HTTP method, ``get`` or ``post``.
+        :param str url: The URL to open.
+        :param kwargs: Passed to the session.
+
+        :return: The response, its status is below 500.
+        :rtype: requests.Response
+
+        :raises RequestError: If the page couldn't be fetched.
+        """
+        attempt = 0
+        self.retry_budget.deposit()
+
+        while True:
+            if not self.breaker.allow():
+                raise RequestError("circuit breaker open, skipping " + url)
+
+            self.counters.hit('http_request')
+            try:
+                started = time.time()
+                try:
+                    request = self.request.request(method, url,
+                                                   timeout=self.timeout,
+                                                   **kwargs)
+                finally:
+                    # failures and timeouts count too
+                    self.metrics.observe('chaturbate_request_seconds',
+                                         time.time() - started)
+                if request.status_code >= 500:
+                    raise requests.exceptions.HTTPError(
+                        "%d error" % request.status_code)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.HTTPError,
+                    requests.exceptions.Timeout) as error:
+                if self.breaker.failure():
+                    self.log.warning("Too many failed requests, pausing "
+                                     "for %ds", self.breaker.cooldown)
+                if not self.retry_budget.withdraw():
+                    self.counters.hit('http_budget_exhausted')
+                    raise RequestError("retry budget exhausted: %s" % error)
+                self.counters.hit('http_retry')
+                delay = min(self.config['http-max-backoff'],
+                            self.config['http-backoff'] * 2 ** attempt)
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+                continue
+            except requests.exceptions.RequestException as error:
+                raise RequestError(str(error))
+
+            self.breaker.success()
+            return request
+
+    def pool_connections(self):
+        """
+        Returns how many connections the pools have opened.
+
+        Compared with the number of requests it shows how well keep-alive
+        connections are reused.
+
+        :rtype: int
+        """
+        pools = self.adapter.poolmanager.pools
+        total = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                total += pool.num_connections
+        return total
 
-        :return: A Popen object (process).
-        :rtype: Popen
+    def fetch_followed(self, url):
         """
-        if sys.version_info[0] < 3:
-            unquote = urllib.unquote(flv_info[15])
-        else:
-            unquote = urllib.parse.unquote(flv_info[15])
+        Fetches and parses a page of the followed cams list.
 
-        arguments = [
-            "rtmpdump",
-            "--quiet",
-            "--live",
-            extra_argument,
-            "--rtmp", "rtmp://" + flv_info[2] + "/live-edge",
-            "--pageUrl", "http://chaturbate.com/" + flv_info[1],
-            "--conn", "S:" + flv_info[8],
-            "--conn", "S:" + flv_info[1],
-            "--conn", "S:2.649",
-            "--conn", "S:" + unquote,
-            "--token", "m9z#$dO0qe34Rxe@sMYxx",
-            "--playpath", "playpath",
-            "--flv", output_filename
-        ]
+        The page is requested with the validators (ETag and Last-Modified)
+        of the last fetch, and it is only parsed again if its content
+        changed.
 
-        return subprocess.Popen(arguments)
+        :param str url: The page URL.
 
-    @staticmethod
-    def get_process_stats(process_info):
+        :rtype: PageState
         """
-        Generates various info about the file being captured.
+        state = self.pages.get(url) or PageState()
+        headers = {}
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.modified:
+            headers['If-Modified-Since'] = state.modified
 
-        :param dict process_info: Information about the rtmpdump process.
+        response = self.get(url, headers)
+        if response.status_code == 304:
+            self.counters.hit('page_unchanged')
+            return state
 
-        :return: Statistics about the recording.
-        :rtype: dict
+        html = response.text
+        fresh = PageState()
+        fresh.etag = response.headers.get('ETag')
+        fresh.modified = response.headers.get('Last-Modified')
+        fresh.digest = hashlib.sha1(html.encode('utf-8')).hexdigest()
+        if fresh.digest == state.digest:
+            self.counters.hit('page_unchanged')
+            fresh.models = state.models
+            fresh.pages = state.pages
+        else:
+            parse = FOLLOWED_PARSERS[self.config['parser']]
+            started = time.time()
+            fresh.models = parse(html)
+            self.metrics.observe('chaturbate_parse_seconds',
+                                 time.time() - started)
+            pages = [int(page) for page in self.page_re.findall(html)]
+            fresh.pages = max(pages + [1])
+        self.pages[url] = fresh
+        return fresh
+
+    def warm_up(self):
         """
-        file_size = int(os.path.getsize(process_info['filename']))
-        return {
-            'file_size': file_size,
-            'formatted_file_size': Chaturbate.get_human_size(file_size),
-            'started_at': time.strftime(
-                "%H:%M", time.localtime(process_info['time'])),
-            'recording_time': str(
-                timedelta(seconds=int(time.time()) - process_info['time']))
-        }
+        Starts fetching the followed cams in the background, logging in if
+        the session expired, while the local checks run.
 
-    def make_request(self, url):
+        The first cycle uses the result instead of fetching it again.
         """
-        Does a GET request and returns the HTML content.
+        def fetch():
+            try:
+                self.fetch_followed(self.base_url + 'followed-cams/')
+            except RequestError as error:
+                self.log.warning("Unable to fetch the followed cams: %s",
+                                 error)
 
-        :param str url: The URL to open.
+        self.warmup = threading.Thread(target=fetch)
+        self.warmup.daemon = True
+        self.warmup.start()
 
-        :return: The HTML source of the requested URL.
-        :rtype: str
+    def get_followed(self):
         """
-        request = None
+        Fetches every page of the followed cams list.
+
+        The first page tells how many pages there are, the others are
+        fetched in parallel. A page that fails keeps its last known models.
 
-        if os.path.isfile('cookie.txt'):
-            with open('cookie.txt', 'r') as f:
-                cookie = requests.utils.cookiejar_from_dict(json.load(f))
+        :return: ``(model, online, private)`` tuples.
+        :rtype: list
+
+        :raises RequestError: If the first page couldn't be fetched.
+        """
+        url = self.base_url + 'followed-cams/'
+        warmup, self.warmup = self.warmup, None
+        if warmup is not None:
+            warmup.join()
+        if warmup is not None and url in self.pages:
+            first = self.pages[url]
         else:
-            cookie = {}
+            first = self.fetch_followed(url)
+        urls = ['%s?page=%d' % (url, page)
+                for page in range(2, first.pages + 1)]
 
-        while request is None:
+        def fetch(page_url):
             try:
-                request = self.request.get(url, timeout=5, cookies=cookie)
-            except (requests.exceptions.ConnectionError,
-                    requests.exceptions.ChunkedEncodingError,
-                    requests.exceptions.Timeout):
-                request = None
+                self.fetch_followed(page_url)
+            except RequestError as error:
+                self.log.warning("Unable to fetch %s: %s", page_url, error)
 
-            while (request is not None) and \
-                    (self.is_logged(request.text) is False):
-                self.log.warning("Not logged in")
-                self.login()
-                try:
-                    request = self.request.get(url, timeout=5, cookies=cookie)
-                except (requests.exceptions.ConnectionError,
-                        requests.exceptions.ChunkedEncodingError,
-                        requests.exceptions.Timeout):
-                    request = None
+        self.parallel(fetch, urls)
 
-        return request.text
+        models = list(first.models)
+        for page_url in urls:
+            if page_url in self.pages:
+                models.extend(self.pages[page_url].models)
+        return models
 
     def get_online_models(self):
         """
@@ -287,28 +3053,78 @@ class Chaturbate(object):
         :return: Online models name.
         :rtype: list
         """
-        url = 'https://chaturbate.com/followed-cams/'
-        html = self.make_request(url)
-        soup = BeautifulSoup(html, "html.parser")
+        # ignore offline models and private shows
+        return [model for model, online, private in self.get_followed()
+                if online and not private]
 
-        models = []
-        models_li = soup.find(
-            'ul', {'class': 'list'}).findAll('li', recursive=False)
+    def get_changes(self):
+        """
+        Fetches the followed cams and compares them with the last fetch.
+
+        :rtype: FollowedDiff
+        """
+        current = {}
+        for model, online, private in self.get_followed():
+            if private:
+                current[model] = 'private'
+            elif online:
+                current[model] = 'online'
+        diff = diff_followed(self.followed, current)
+        self.followed = current
+        return diff
 
-        for model in models_li:
-            model_name = model.find('a')['href'].replace('/', '')
+    def discover(self):
+        """
+        Returns the online models this node should record.
 
-            # ignore offline
-            if model.find('div', {'class': 'thumbnail_label_offline'}):
-                continue
+        Alone, those are the models that came online since the last fetch,
+        followed by the ones still online that aren't being recorded yet,
+        so the work of a cycle grows with the changes and not with the size
+        of the followed list. In a cluster every node publishes its own
+        followed models (each node can log in with a different account) and
+        records its share of all of them, picked by consistent hashing over
+        the live nodes.
 
-            # ignore private shows
-            if model.find('div', {'class': 'thumbnail_label_c_private_show'}):
-                continue
+        Models that came online are handed to the :class:`Scheduler` for
+        fast re-checks, except on the first fetch, and their negative
+        :class:`DiscoveryCache` entries are cleared.
 
-            models.append(model_name)
+        :rtype: list
+        """
+        known = bool(self.followed)
+        diff = self.get_changes()
+        others = len(diff.offline) + len(diff.private)
+        for model in diff.offline:
+            # the cached stream won't be valid on the next show
+            self.discovery.forget(model)
+        for model in diff.online:
+            # the page says the show is public again
+            self.discovery.succeeded(model)
+        if diff.online or diff.offline or diff.private:
+            self.log.info("%d came online, %d went offline, "
+                          "%d went private", len(diff.online),
+                          len(diff.offline), len(diff.private))
 
-        return models
+        models = [model for model, status in sorted(self.followed.items())
+                  if status == 'online']
+        if self.cluster is None:
+            if known:
+                self.scheduler.watch(diff.online, others)
+            waiting = [model for model in models
+                       if model not in diff.online and
+                       not self.is_recording(model)]
+            return diff.online + waiting
+
+        self.cluster.publish(models)
+        node = self.config['cluster-node']
+        ring = HashRing(set(self.cluster.nodes()) | set([node]),
+                        self.config['cluster-replicas'])
+        self.ring = ring
+        if known:
+            self.scheduler.watch([model for model in diff.online
+                                  if ring.node(model) == node], others)
+        return [model for model in self.cluster.online()
+                if ring.node(model) == node]
 
     def is_recording(self, model_name):
         """
@@ -318,155 +3134,461 @@ class Chaturbate(object):
 
         :rtype: bool
         """
-        for process in self.processes:
-            if process['model'] == model_name and \
-                            process['type'] == 'rtmpdump':
-                return True
+        return self.processes.get(model_name, 'rtmpdump') is not None
+
+    def process_model(self, model):
+        """
+        Fetches the embed info of a model, probes it and starts capturing.
+
+        Models that were recently private or had no embed are skipped until
+        their :class:`DiscoveryCache` entry expires. In a cluster the model
+        must belong to this node and its lease is taken first, so nodes
+        don't fetch and probe the shows they won't record.
+
+        :param str model: The model name.
+        """
+        if self.discovery.blocked(model) is not None:
+            return
+
+        if self.cluster is not None:
+            if self.ring is not None and \
+                    self.ring.node(model) != self.config['cluster-node']:
+                return
+            if not self.cluster.claim(model):
+                self.log.info("%s is recorded by another node", model)
+                return
 
-        return False
+        self.log.info("Model " + model + " is chaturbating")
+        probe = Job('probe-' + model, 'probe', model,
+                    state=ProcessRegistry.PROBING)
+        self.processes.add(probe)
+        try:
+            info = self.discovery.get_stream(model)
+            if info is None:
+                try:
+                    info = self.get_flv_info(model)
+                except RequestError as error:
+                    self.log.warning("Unable to fetch %s: %s", model, error)
+                    return
+                # if the embed info was scrapped
+                if info is None:
+                    self.discovery.put_negative(model, 'embed')
+                    return
+                # a hit doesn't renew it, so it expires while watched
+                self.discovery.put_stream(model, info)
+            # check if the show is private
+            if self.is_private(info) is False:
+                self.discovery.succeeded(model)
+                self.capture(info)
+            else:
+                # the stream may have moved, fetch it again next time
+                self.discovery.drop_stream(model)
+                delay = self.discovery.put_negative(model, 'private')
+                self.log.warning("But the show is private, "
+                                 "retrying in %ds", delay)
+        finally:
+            self.processes.remove(probe)
+            if self.cluster is not None and not self.is_recording(model):
+                # another node may record it
+                self.cluster.release(model)
 
     def process_models(self, models):
         """
         Processes a list that has the online models and starts capturing them.
 
+        The page fetch and the private show probe of every model run in a
+        pool of ``workers`` threads, so each capture starts as soon as its
+        own probe passes.
+
         :param list models: The models.
         """
-        for model in models:
-            # already recording it, ignore
-            if self.is_recording(model) is True:
-                continue
-            self.log.info("Model " + model + " is chaturbating")
-            info = self.get_flv_info(model)
-            # if the embed info was scrapped
-            if len(info) > 0:
-                # check if the show is private
-                if self.is_private(info) is False:
-                    self.capture(info)
-                else:
-                    self.log.warning("But the show is private")
+        # already recording it, ignore
+        self.parallel(self.process_model,
+                      [model for model in models
+                       if self.is_recording(model) is False])
+
+    def parallel(self, function, items):
+        """
+        Calls a function with every item in a pool of ``workers`` threads,
+        and waits for all of them.
+
+        :param function: The function, its exceptions are logged.
+        :param list items: The items.
+        """
+        pending = queue.Queue()
+        for item in items:
+            pending.put(item)
+
+        def worker():
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    function(item)
+                except Exception:
+                    self.log.exception("Failed to process %s", item)
+
+        workers = []
+        for _ in range(min(self.config['workers'], pending.qsize())):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+        for thread in workers:
+            thread.join()
 
     def get_flv_info(self, model_name):
         """
-        Generates a list with all EmbedViewerSwf variables from the HTML.
+        Reads the stream information from the EmbedViewerSwf call in the HTML.
 
         :param str model_name: The model name to get info.
 
-        :return: Information from the FLV player.
-        :rtype: list
+        :return: Information from the FLV player, None if it wasn't found.
+        :rtype: StreamInfo
         """
-        url = "https://chaturbate.com/" + model_name + "/"
+        url = self.base_url + model_name + "/"
         html = self.make_request(url)
 
-        flv_info = []
+        try:
+            return extract_stream_info(html)
+        except EmbedError as error:
+            self.log.warning("Cant find embed: %s", error)
+            return None
+
+    def capture(self, flv_info):
+        """
+        Capture a stream.
 
-        embed = re.search(r"EmbedViewerSwf\(*(.+?)\);", html, re.DOTALL)
-        if embed is None:
-            self.log.warning('Cant find embed')
-            return flv_info
+        Starts the capture backend and hands it to :meth:`supervise`.
 
-        for line in embed.group(1).split("\n"):
-            data = re.search(r" +[\"'](.*)?[\"'],", line)
-            if data:
-                flv_info.append(data.group(1))
+        With segmented recording enabled, the stream is written by a
+        :class:`SegmentWriter` and every finished segment is finalized
+        while the show goes on.
 
-        return flv_info
+        In FFmpeg live mode the stream is piped straight into ffmpeg, and
+        the final file is ready as soon as the show ends.
 
-    def capture(self, flv_info):
+        :param StreamInfo flv_info: The stream information.
         """
-        Capture a stream.
+        live = self.config['ffmpeg'] == 'true' and \
+            self.config['ffmpeg-live'] == 'true'
+        filename = self.capture_filename(flv_info.room)
+        if live:
+            # remux while recording, the flv never touches the disk
+            filename = os.path.splitext(filename)[0] + '.mp4'
+        self.log.info("Capturing %s", os.path.basename(filename))
+
+        job = Job('rtmp-' + flv_info.room, 'rtmpdump', flv_info.room,
+                  state=ProcessRegistry.CAPTURING, filename=filename)
+
+        if live:
+            job.process = self.backend.start_piped(
+                flv_info, self.ffmpeg_arguments('-', filename))
+            if self.journal is not None:
+                self.journal.record(filename, job)
+            self.supervise(job)
+            return
+
+        output = None
+        if self.config['segment-duration'] > 0 or \
+                self.config['segment-size'] > 0:
+            output = SegmentWriter(
+                filename,
+                lambda: self.capture_filename(flv_info.room),
+                lambda finished, current, started: self.rotate_segment(
+                    job, finished, current, started),
+                duration=self.config['segment-duration'],
+                size=self.config['segment-size'],
+                flv=self.backend.is_flv(flv_info),
+                first_byte=lambda: self.mark_first_byte(job))
+
+        job.process = self.backend.start(
+            flv_info, filename, output,
+            first_byte=lambda: self.mark_first_byte(job))
+
+        if self.journal is not None:
+            self.journal.record(filename, job)
+        self.supervise(job)
+
+    def mark_first_byte(self, job):
+        """
+        Records when the first data of a capture arrived.
+
+        Called by the backends and the segment writer as the data comes
+        in. Captures that write their own files, like rtmpdump, are
+        noticed by :meth:`sample_captures` instead.
 
-        Starts rtmpdump and adds information to the :data:`processes` list.
+        :param Job job: The capture.
+        """
+        if job.first_byte is not None:
+            return
+        job.first_byte = time.time()
+        self.metrics.observe('chaturbate_first_byte_seconds',
+                             job.first_byte - job.time)
+
+    def capture_filename(self, model):
+        """
+        Returns the path of a new recording.
+
+        :param str model: The model name.
 
-        :param list flv_info: A list with all the flv info.
+        :rtype: str
         """
         date_time = datetime.now()
+        name = "Chaturbate_" + model + date_time.strftime("_%Y-%m-%dT%H%M%S")
+        filename = os.path.join(self.config['capturing_path'], name + ".flv")
+        # segments can rotate more than once per second
+        number = 1
+        while os.path.exists(filename):
+            filename = os.path.join(self.config['capturing_path'],
+                                    "%s-%d.flv" % (name, number))
+            number += 1
+        return filename
+
+    def rotate_segment(self, job, finished, current, started):
+        """
+        Finalizes a finished segment of a capture that goes on.
+
+        It runs on the thread writing the stream, the native backend's
+        event loop for instance, so only the file switch happens here. The
+        journal and the finalization are left to :meth:`finish_segments`.
+
+        :param Job job: The capture.
+        :param str finished: The finished segment.
+        :param str current: The segment being written now.
+        :param float started: When the finished segment was started.
+        """
+        job.filename = current
+        job.size = 0
+        job.sampled = None
+
+        segment = Job(job.id, 'segment', job.model,
+                      state=ProcessRegistry.FINALIZING, filename=finished)
+        segment.time = int(started)
+        self.segments.put((job, current, segment))
+        with self.segment_lock:
+            if self.segmenter is None:
+                self.segmenter = threading.Thread(
+                    target=self.finish_segments)
+                self.segmenter.daemon = True
+                self.segmenter.start()
+
+    def finish_segments(self):
+        """
+        Journals and finalizes the finished segments, one at a time.
+        """
+        while True:
+            job, current, segment = self.segments.get()
+            try:
+                # the capture may be over already
+                if self.journal is not None and \
+                        job.state == ProcessRegistry.CAPTURING:
+                    self.journal.record(current, job)
+                self.finalize_recording(segment)
+                if self.journal is not None:
+                    self.journal.remove(segment.filename)
+            except (IOError, OSError, sqlite3.Error) as error:
+                self.log.error("Unable to finalize %s: %s",
+                               segment.filename, error)
+
+    def recover(self):
+        """
+        Resumes the work left behind by a previous run, using the journal.
 
-        filename = ("Chaturbate_" + flv_info[1] +
-                    date_time.strftime("_%Y-%m-%dT%H%M%S") + ".flv")
-        self.log.info("Capturing %s", filename)
+        * Captures whose rtmpdump is still running are adopted.
+        * Other leftover flv files in the capturing path are finalized.
+        * Unfinished or failed transcodes are queued again.
+        """
+        transcodes = self.journal.jobs('ffmpeg')
 
-        filename = os.path.join(self.config['capturing_path'], filename)
+        adopted = set()
+        for path, model, _, _, pid, started in self.journal.jobs('rtmpdump'):
+            if not os.path.isfile(path):
+                self.journal.remove(path)
+            elif pid and AdoptedProcess.is_alive(pid, path):
+                self.log.info("Adopting capture of %s", model)
+                job = Job('rtmp-' + model, 'rtmpdump', model,
+                          process=AdoptedProcess(pid, path),
+                          state=ProcessRegistry.CAPTURING, filename=path)
+                job.time = started
+                self.supervise(job)
+                adopted.add(path)
 
-        process = self.run_rtmpdump(flv_info, filename)
+        for filename in sorted(os.listdir(self.config['capturing_path'])):
+            path = os.path.join(self.config['capturing_path'], filename)
+            match = self.capture_re.match(filename)
+            if match is None or path in adopted:
+                continue
+            self.log.info("Finalizing leftover %s", filename)
+            job = Job('rtmp-' + match.group(1), 'rtmpdump', match.group(1),
+                      state=ProcessRegistry.FINALIZING, filename=path)
+            job.time = int(os.path.getmtime(path))
+            self.clean_rtmpdump(job)
+            self.journal.remove(path)
 
-        self.processes.append(
-            {
-                'id': 'rtmp-' + flv_info[1],
-                'type': 'rtmpdump',
-                'model': flv_info[1],
-                'filename': filename,
-                'time': int(time.time()),
-                'process': process,
-            })
+        for path, model, _, destination, pid, _ in transcodes:
+            self.journal.remove(path)
+            if pid and AdoptedProcess.is_alive(pid, path):
+                # the output is incomplete, start over
+                AdoptedProcess(pid).terminate()
+            if os.path.isfile(path) and self.config['ffmpeg'] == "true":
+                self.log.info("Queueing transcode of %s again", path)
+                self.queue_ffmpeg(model, path, destination)
 
     def clean_rtmpdump(self, process_info):
         """
         Processes the flv after rtmpdump stops.
 
-        :param dict process_info: Information about the rtmpdump process.
+        :param Job process_info: Information about the rtmpdump process.
+        """
+        self.log.info("%s is no longer being captured", process_info.model)
+        self.finalize_recording(process_info)
+
+    def finalize_recording(self, process_info):
+        """
+        Deletes an empty recording or moves it to the completed path.
+
+        :param Job process_info: Information about the recording.
+        """
+        if not os.path.isfile(process_info.filename):
+            # nothing was recorded, the cached stream may be stale
+            self.discovery.forget(process_info.model)
+            return
+
+        process_stats = self.get_process_stats(process_info)
+        if process_stats['file_size'] == 0:
+            self.log.warning("Capture size is 0kb, deleting.")
+            os.remove(process_info.filename)
+            # the cached stream may be stale
+            self.discovery.forget(process_info.model)
+        else:
+            self.move_to_complete(process_info)
+            self.log.info("Finished: %s - Started at %s | " +
+                          "Size: %s | Duration: %s",
+                          process_info.model,
+                          process_stats['started_at'],
+                          process_stats['formatted_file_size'],
+                          process_stats['recording_time'])
+
+    def supervise(self, process_info):
+        """
+        Adds a process to the :data:`processes` registry and watches it.
+
+        A daemon thread waits for the child to exit and calls
+        :meth:`finish_process` right away, so finished recordings don't
+        wait for the next cycle.
+
+        :param Job process_info: Information about the process.
+        """
+        if process_info not in self.processes:
+            self.processes.add(process_info)
+
+        def waiter():
+            process_info.process.wait()
+            self.finish_process(process_info)
+
+        thread = threading.Thread(target=waiter)
+        thread.daemon = True
+        thread.start()
+
+    def finish_process(self, process_info):
+        """
+        Handles a process that has stopped and removes it from the registry.
+
+        If ffmpeg exited correctly, deletes the flv file.
+
+        :param Job process_info: Information about the process.
         """
-        self.log.info("%s is no longer being captured", process_info['model'])
-        if os.path.isfile(process_info['filename']):
-            process_stats = self.get_process_stats(process_info)
-            if process_stats['file_size'] == 0:
-                self.log.warning("Capture size is 0kb, deleting.")
-                os.remove(process_info['filename'])
+        if process_info.type == 'rtmpdump':
+            with self.processes.lock:
+                if process_info.state != ProcessRegistry.CAPTURING:
+                    # already handled by another caller
+                    return
+                self.processes.set_state(process_info,
+                                         ProcessRegistry.FINALIZING)
+            try:
+                self.clean_rtmpdump(process_info)
+            finally:
+                self.processes.remove(process_info)
+            if self.journal is not None:
+                self.journal.remove(process_info.filename)
+            if self.cluster is not None:
+                self.cluster.release(process_info.model)
+            return
+
+        if self.processes.remove(process_info) is False:
+            # already handled by another caller
+            return
+
+        if process_info.type == 'ffmpeg':
+            if process_info.process.returncode == 0:
+                self.log.debug("Deleting %s", process_info.source)
+                os.remove(process_info.source)
+                self.index.discard(process_info.source)
+                self.index.add(process_info.destination, process_info.model)
+                if self.journal is not None:
+                    self.journal.remove(process_info.source)
             else:
-                self.move_to_complete(process_info)
-                self.log.info("Finished: %s - Started at %s | " +
-                              "Size: %s | Duration: %s",
-                              process_info['model'],
-                              process_stats['started_at'],
-                              process_stats['formatted_file_size'],
-                              process_stats['recording_time'])
+                self.log.warning("ffmpeg transcode failed, not deleting flv")
+                if self.journal is not None:
+                    self.processes.set_state(process_info, 'failed')
+                    self.journal.record(process_info.source, process_info)
+            self.start_transcodes()
 
     def is_running(self):
         """
         Checks if a process is still running, if isn't remove it from list.
 
-        If ffmpeg exited correctly, deletes the flv file.
+        Exits are normally handled as they happen by :meth:`supervise`, this
+        is only a safety net.
         """
-        remove = []
-
-        # iterate over all "running" processes
         for process in self.processes:
             # if the process has stopped
-            if process['process'].poll() is not None:
-                if process['type'] == 'rtmpdump':
-                    self.clean_rtmpdump(process)
-                elif process['type'] == 'ffmpeg':
-                    if process['process'].poll() == 0:
-                        if self.config['debug'] == 'true':
-                            self.log.info("Deleting %s", process['source'])
-                        os.remove(process['source'])
-                    else:
-                        self.log.warning(
-                            "ffmpeg transcode failed, not deleting flv")
+            if process.process is not None and \
+                    process.process.poll() is not None:
+                self.finish_process(process)
 
-                remove.append(process['id'])
-
-        # remove all items in remove from self.processes
-        temp_processes = self.processes
-        for item in remove:
-            temp_processes = [f for f in temp_processes if f['id'] != item]
-        self.processes = temp_processes
-
-    def kill_processes(self):
+    def kill_processes(self, timeout=10):
         """
         Kills all child processes, used when ^C is pressed.
+
+        Then waits, for at most ``timeout`` seconds in all, until they are
+        over, so the in-process captures flush their write buffers before
+        the program exits.
+
+        :param float timeout: Seconds to wait.
         """
-        for process in self.processes:
-            if process['process'].poll() is not None:
-                process['process'].terminate()
+        running = [process.process for process in self.processes
+                   if process.process is not None and
+                   process.process.poll() is None]
+        for process in running:
+            process.terminate()
+
+        deadline = time.time() + timeout
+        for process in running:
+            # Popen.wait has no timeout on Python 2
+            waiter = threading.Thread(target=process.wait)
+            waiter.daemon = True
+            waiter.start()
+            waiter.join(max(deadline - time.time(), 0))
 
     def login(self):
         """
         Performs the login on the site.
+
+        Both requests go through the retry policy of :meth:`send`.
+
+        :raises RequestError: If the login pages couldn't be fetched.
         """
         self.log.info("Logging in...")
-        url = 'https://chaturbate.com/'
-        result = self.request.get(url)
+        self.counters.hit('login')
+        url = self.base_url
+        result = self.send('get', url)
 
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(result.text, "html.parser")
 
         if soup.find('div', {'class': 'g-recaptcha'}):
@@ -476,102 +3598,381 @@ class Chaturbate(object):
 
         csrf = soup.find('input', {'name': 'csrfmiddlewaretoken'}).get('value')
 
-        url = 'https://chaturbate.com/auth/login/?next=/'
-
-        result = self.request.post(url,
-                                   data={
-                                       'csrfmiddlewaretoken': csrf,
-                                       'username': self.config['username'],
-                                       'password': self.config['password'],
-                                       'rememberme': 'on',
-                                       'next': '/',
-                                   },
-                                   cookies=result.cookies,
-                                   headers={
-                                       'user-agent': self.agent,
-                                       'Referer': url
-                                   })
+        url = self.base_url + 'auth/login/?next=/'
+
+        result = self.send('post', url,
+                           data={
+                               'csrfmiddlewaretoken': csrf,
+                               'username': self.config['username'],
+                               'password': self.config['password'],
+                               'rememberme': 'on',
+                               'next': '/',
+                           },
+                           cookies=result.cookies,
+                           headers={
+                               'user-agent': self.agent,
+                               'Referer': url
+                           })
 
         if self.is_logged(result.text) is False:
             self.log.warning("Could not login")
             sys.exit("BYE!")
             return False
         else:
-            with open('cookie.txt', 'w') as f:
-                json.dump(requests.utils.dict_from_cookiejar(result.cookies), f)
+            self.save_cookies()
             return True
 
     def do_cycle(self):
         """
         Does a full cycle.
 
-        * Checks the processes.
-        * Gets online models.
+        * Checks the processes and renews their cluster leases.
+        * Checks the free space and applies the retention policies.
+        * Gets online models (this node's share of them in a cluster),
+          unless the disk is almost full.
         * Process them.
+
+        The duration of the cycle is stored in :data:`cycle_time`, and the
+        :class:`Scheduler` picks the next :data:`interval`.
+        """
+        started = time.time()
+        self.scheduler.start_cycle()
+        self.is_running()
+        self.maintain()
+        self.process_models(self.find_models())
+        self.cycle_time = time.time() - started
+        self.scheduler.finish_cycle()
+        self.interval = self.scheduler.interval
+        self.report()
+
+    def maintain(self):
+        """
+        Renews the cluster leases, stopping the captures whose lease another
+        node took, samples the free space, applies the retention policies
+        and resumes paused transcodes.
+
+        Exits if the capture backend can't work.
+        """
+        self.backend.check()
+        if self.cluster is not None:
+            self.cluster.heartbeat()
+            for model in self.cluster.renew(
+                    [job.model for job in self.processes.by_type('rtmpdump')]):
+                job = self.processes.get(model, 'rtmpdump')
+                if job is not None and job.process is not None and \
+                        job.stopping is None:
+                    self.log.warning("Lost the lease of %s to another node, "
+                                     "stopping its capture", model)
+                    # check_health kills it if it doesn't stop in time
+                    job.stopping = time.time()
+                    job.process.terminate()
+        self.storage.sample()
+        self.enforce_retention()
+        self.start_transcodes()
+
+    def find_models(self):
+        """
+        Returns the models to process this cycle, see :meth:`discover`.
+
+        :return: The models, empty if the disk is almost full or the
+                 followed cams couldn't be fetched.
+        :rtype: list
+        """
+        if not self.storage.has_room(self.config['capturing_path'],
+                                     self.interval):
+            self.log.warning("Low disk space in %s, not starting captures",
+                             self.config['capturing_path'])
+            return []
+        try:
+            return self.discover()
+        except RequestError as error:
+            self.log.warning("Skipping cycle: %s", error)
+            return []
+
+    def report(self):
         """
-        c.is_running()
-        online_models = self.get_online_models()
-        self.process_models(online_models)
+        Samples the captures, updates the metrics and logs the status.
+        """
+        self.sample_captures()
+        self.update_metrics()
         self.print_recording()
         if self.config['debug'] == 'true':
             self.print_status()
 
-    def print_status(self):
+    def recheck(self):
         """
-        Prints number of rtmpdump and ffmpeg processes running.
+        Runs the fast re-checks that are due, between two cycles.
+
+        Only models that aren't being recorded are probed again, and
+        nothing is started while the disk is almost full.
         """
-        capturing = 0
-        processing = 0
+        self.process_models(self.due_rechecks())
 
-        for process in self.processes:
-            if process['type'] == 'rtmpdump':
-                capturing += 1
-            if process['type'] == 'ffmpeg':
-                processing += 1
+    def due_rechecks(self):
+        """
+        Returns the models whose fast re-check is due.
+
+        :rtype: list
+        """
+        models = [model for model in self.scheduler.due_rechecks()
+                  if not self.is_recording(model)]
+        if not models or not self.storage.has_room(
+                self.config['capturing_path'], self.interval):
+            return []
+        for model in models:
+            self.counters.hit('recheck')
+        return models
+
+    def enforce_retention(self):
+        """
+        Deletes the oldest recordings in the completed path that break the
+        retention policies of the ``[Retention]`` section.
+
+        Recordings still being transcoded are kept.
+        """
+        if not (self.config['retention-max-age'] or
+                self.config['retention-max-size'] or
+                self.config['retention-model-quota']):
+            return
+        busy = set(job.source for job in self.processes.by_type('ffmpeg'))
+        for filename in self.index.expired(
+                self.config['retention-max-age'],
+                self.config['retention-max-size'],
+                self.config['retention-model-quota'], busy):
+            try:
+                os.remove(filename)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    self.log.warning("Unable to delete %s: %s", filename,
+                                     error)
+                    continue
+            self.index.discard(filename)
+            self.counters.hit('retention_delete')
+            self.log.info("Deleted %s (retention)", os.path.basename(filename))
+
+    def sample_captures(self):
+        """
+        Stats every active capture once and updates its size and write rate.
+
+        The first time a capture has data, its time to first byte is
+        recorded. Then :meth:`check_health` looks for stalled captures.
+        """
+        with self.sample_lock:
+            now = time.time()
+            for process in self.processes.by_type('rtmpdump'):
+                if process.state != ProcessRegistry.CAPTURING:
+                    continue
+                try:
+                    size = os.stat(process.filename).st_size
+                except OSError:
+                    # not created yet, or rotated meanwhile
+                    size = 0
+                # a rotation starts a new file, only count growth
+                grown = max(size - process.size, 0)
+                if process.sampled is not None and now > process.sampled:
+                    process.rate = grown / (now - process.sampled)
+                if grown > 0:
+                    process.grown = now
+                    process.written += grown
+                process.history.append((now, process.written))
+                if size > 0:
+                    # only rounded to the sampling period here
+                    self.mark_first_byte(process)
+                process.size = size
+                process.sampled = now
+            self.check_health(now)
+
+    def check_health(self, now):
+        """
+        Restarts the captures that wrote nothing for ``stall`` seconds, or
+        less than ``min-rate`` KB/s over ``window`` seconds (see the
+        ``[Health]`` section).
+
+        The capture is terminated, finalized like any other, and the model
+        is re-checked soon so a fresh capture starts.
+
+        :param float now: When the captures were sampled.
+        """
+        stall = self.config['health-stall']
+        min_rate = self.config['health-min-rate']
+        window = self.config['health-window']
+        for process in self.processes.by_type('rtmpdump'):
+            if process.state != ProcessRegistry.CAPTURING or \
+                    process.process is None:
+                continue
+            if process.stopping is not None:
+                if now - process.stopping > 10 and \
+                        process.process.poll() is None:
+                    process.process.kill()
+                continue
+
+            reason = None
+            idle = now - (process.grown or process.time)
+            if stall > 0 and idle > stall:
+                reason = "no data for %ds" % idle
+            elif min_rate > 0:
+                rate, span = process.bitrate(window)
+                if span >= window and rate < min_rate:
+                    reason = "only %s/s" % self.get_human_size(int(rate))
+            if reason is None:
+                continue
 
-        self.log.info("Capturing: %d, Processing: %d",
-                      capturing, processing)
+            self.log.warning("Restarting the capture of %s: %s",
+                             process.model, reason)
+            self.counters.hit('capture_restart')
+            process.stopping = now
+            # the stream may have moved to another server
+            self.discovery.forget(process.model)
+            self.scheduler.watch([process.model])
+            process.process.terminate()
+
+    def update_metrics(self):
+        """
+        Refreshes the gauges and writes the metrics file, if configured.
+        """
+        self.metrics.set('chaturbate_cycle_seconds', self.cycle_time or 0)
+        self.metrics.set('chaturbate_interval_seconds', self.interval)
+        self.metrics.set('chaturbate_capture_restarts_total',
+                         self.counters.total('capture_restart'))
+        self.metrics.set('chaturbate_scheduler_lag_seconds',
+                         self.scheduler.lag)
+        self.metrics.set('chaturbate_rechecks_total',
+                         self.counters.total('recheck'))
+        self.metrics.set('chaturbate_captures',
+                         self.processes.count(ProcessRegistry.CAPTURING))
+        self.metrics.set('chaturbate_transcodes',
+                         self.processes.count(ProcessRegistry.TRANSCODING))
+        self.metrics.set('chaturbate_transcodes_queued',
+                         self.processes.count(ProcessRegistry.QUEUED))
+        self.metrics.set('chaturbate_http_requests_total',
+                         self.counters.total('http_request'))
+        self.metrics.set('chaturbate_http_retries_total',
+                         self.counters.total('http_retry'))
+        self.metrics.set('chaturbate_http_budget_exhausted_total',
+                         self.counters.total('http_budget_exhausted'))
+        self.metrics.set('chaturbate_http_breaker_open',
+                         1 if self.breaker.is_open() else 0)
+        self.metrics.set('chaturbate_http_connections_total',
+                         self.pool_connections())
+        self.metrics.set('chaturbate_followed_pages_unchanged_total',
+                         self.counters.total('page_unchanged'))
+        for path in self.storage.paths:
+            if path in self.storage.free:
+                self.metrics.set('chaturbate_disk_free_bytes',
+                                 self.storage.free[path], path)
+                self.metrics.set('chaturbate_disk_write_bytes_per_second',
+                                 self.storage.rate.get(path, 0), path)
+        self.metrics.set('chaturbate_completed_bytes', self.index.total)
+        self.metrics.set('chaturbate_retention_deleted_total',
+                         self.counters.total('retention_delete'))
+        self.metrics.reset('chaturbate_capture_bytes_per_second')
+        for process in self.processes.by_type('rtmpdump'):
+            if process.state == ProcessRegistry.CAPTURING:
+                self.metrics.set('chaturbate_capture_bytes_per_second',
+                                 process.rate, process.model)
+
+        if self.config['metrics-file']:
+            temp_fn = self.config['metrics-file'] + '.tmp'
+            with open(temp_fn, 'w') as f:
+                f.write(self.metrics.render())
+            os.rename(temp_fn, self.config['metrics-file'])
+
+    def serve_metrics(self, port):
+        """
+        Serves the metrics on http://127.0.0.1:port/metrics.
+
+        :param int port: TCP port.
+        """
+        server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+        server.metrics = self.metrics
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def print_status(self):
+        """
+        Prints number of rtmpdump and ffmpeg processes running.
+        """
+        self.log.info("Probing: %d, Capturing: %d, Finalizing: %d, "
+                      "Processing: %d, Cycle: %.2fs, "
+                      "Logins/h: %d, Cookie reloads/h: %d, "
+                      "Cache hits: %d, misses: %d, "
+                      "Queued: %d, Longest wait: %ds, "
+                      "Interval: %ds, Lag: %.1fs",
+                      self.processes.count(ProcessRegistry.PROBING),
+                      self.processes.count(ProcessRegistry.CAPTURING),
+                      self.processes.count(ProcessRegistry.FINALIZING),
+                      self.processes.count(ProcessRegistry.TRANSCODING),
+                      self.cycle_time or 0,
+                      self.counters.per_hour('login'),
+                      self.counters.per_hour('cookie_reload'),
+                      self.discovery.hits, self.discovery.misses,
+                      self.processes.count(ProcessRegistry.QUEUED),
+                      self.transcode_wait(),
+                      self.interval, self.scheduler.lag)
 
     def print_recording(self):
         """
         Print statistics about cams being recorded.
+
+        The rate is the one of the last sample, the average covers the
+        ``[Health]`` window. With ``recordings=summary`` in the ``[Log]``
+        section, or ``auto`` and many captures, a single line sums up all
+        of them.
         """
-        for process in self.processes:
-            if process['type'] == 'rtmpdump' and \
-                    os.path.isfile(process['filename']):
-                process_stats = self.get_process_stats(process)
-                if process_stats['file_size'] > 0:
-                    self.log.info("Recording: %s - Duration: %s - Size: %s",
-                                  process['model'],
-                                  process_stats['recording_time'],
-                                  process_stats['formatted_file_size']
-                                 )
+        recordings = [process
+                      for process in self.processes.by_type('rtmpdump')
+                      if process.state == ProcessRegistry.CAPTURING and
+                      process.size > 0]
+        if not recordings or not self.log.isEnabledFor(logging.INFO):
+            return
+
+        mode = self.config['log-recordings']
+        if mode == 'summary' or \
+                (mode == 'auto' and len(recordings) > self.summary_threshold):
+            size = sum(process.size for process in recordings)
+            rate = sum(process.rate for process in recordings)
+            slowest = min(recordings, key=lambda process: process.rate)
+            self.log.info("Recording: %d shows - Size: %s - Rate: %s/s - "
+                          "Slowest: %s (%s/s)", len(recordings),
+                          self.get_human_size(size),
+                          self.get_human_size(int(rate)), slowest.model,
+                          self.get_human_size(int(slowest.rate)),
+                          extra={'captures': len(recordings), 'bytes': size,
+                                 'bytes_per_second': rate})
+            return
+
+        for process in recordings:
+            process_stats = self.get_process_stats(process, process.size)
+            average = process.bitrate(self.config['health-window'])[0]
+            self.log.info("Recording: %s - Duration: %s - Size: %s "
+                          "- Rate: %s/s - Average: %s/s",
+                          process.model,
+                          process_stats['recording_time'],
+                          process_stats['formatted_file_size'],
+                          self.get_human_size(int(process.rate)),
+                          self.get_human_size(int(average)),
+                          extra={'model': process.model,
+                                 'bytes': process.size,
+                                 'bytes_per_second': process.rate})
 
     def is_private(self, rtmp_info):
         """
         Checks if a stream is private.
 
-        Runs rtmpdump for a few seconds and checks if the file size is > 0.
+        Asks the capture backend if any bytes arrive before the probe
+        timeout. Nothing is written to disk.
 
-        :param list rtmp_info: A list with all the rtmp info.
+        :param StreamInfo rtmp_info: The stream information.
 
         :rtype: bool
         """
-        result = True
-        seconds = 2
+        started = time.time()
 
-        date_time = datetime.now()
-        filename = ("test-" + rtmp_info[1] +
-                    date_time.strftime("_%Y-%m-%dT%H%M%S") + ".flv")
-        filename = os.path.join(self.config['capturing_path'], filename)
-        process = self.run_rtmpdump(
-            rtmp_info, filename, extra_argument="-B " + str(seconds))
-        process.wait()
-
-        if os.path.isfile(filename):
-            if os.path.getsize(filename) > 0:
-                result = False
-            os.remove(filename)
+        result = not self.backend.probe(rtmp_info,
+                                        self.config['probe-timeout'])
+
+        self.metrics.observe('chaturbate_probe_seconds', time.time() - started)
 
         return result
 
@@ -579,58 +3980,203 @@ class Chaturbate(object):
         """
         Moves the recorded file to the completed path.
 
+        A rename is used when both paths are on the same filesystem.
+        Otherwise the file is copied by a background thread, see
+        :meth:`copy_to_complete`, so the caller never waits for the copy.
+
         If ffmpeg postprocessing is enabled, its called after the move.
 
-        :param dict process: A dict with information about a rtmpdump process.
+        :param Job process: Information about a rtmpdump process.
         """
-        source = process['filename']
-        flv = source.replace(
-            self.config['capturing_path'] + os.sep,
-            self.config['completed_path'] + os.sep)
-        os.rename(source, flv)
+        source = process.filename
+        flv = os.path.join(self.config['completed_path'],
+                           os.path.basename(source))
+        try:
+            os.rename(source, flv)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            job = Job('move-' + os.path.basename(source), 'move',
+                      process.model, state=ProcessRegistry.FINALIZING,
+                      source=source, destination=flv)
+            self.processes.add(job)
+            self.moves.put(job)
+            if self.mover is None:
+                self.mover = threading.Thread(target=self.copy_to_complete)
+                self.mover.daemon = True
+                self.mover.start()
+            return
 
-        if self.config['ffmpeg'] == "true":
-            mp4 = flv.replace(".flv", ".mp4")
-            self.run_ffmpeg(process['model'], flv, mp4)
+        self.after_move(process.model, flv)
 
-    def run_ffmpeg(self, model_name, source_fn, destination_fn):
+    def after_move(self, model, flv):
         """
-        Executes ffmpeg to postprocess recording.
+        Queues the transcode of a recording in the completed path.
+
+        Recordings remuxed in FFmpeg live mode are already final.
+
+        :param str model: The model name.
+        :param str flv: The recording.
+        """
+        self.index.add(flv, model)
+        if self.config['ffmpeg'] == "true" and flv.endswith(".flv"):
+            mp4 = os.path.splitext(flv)[0] + ".mp4"
+            self.queue_ffmpeg(model, flv, mp4)
+
+    def copy_to_complete(self):
+        """
+        Copies the recordings to another filesystem, one at a time.
+
+        The copy is fsynced (and its checksum verified, unless disabled in
+        the ``[Finalize]`` section) before the source is deleted. If the
+        copy fails the source is kept, it is finalized again on the next
+        start.
+        """
+        while True:
+            job = self.moves.get()
+            started = time.time()
+            try:
+                size, checksum = copy_file(
+                    job.source, job.destination,
+                    self.config['finalize-verify'] == 'true')
+                os.remove(job.source)
+            except (IOError, OSError) as error:
+                self.log.error("Unable to move %s: %s", job.source, error)
+                self.processes.remove(job)
+                continue
+
+            elapsed = max(time.time() - started, 0.001)
+            self.log.info("Moved %s (%s) in %.1fs at %s/s%s",
+                          os.path.basename(job.source),
+                          self.get_human_size(size), elapsed,
+                          self.get_human_size(int(size / elapsed)),
+                          " sha256 " + checksum if checksum else "")
+            self.processes.remove(job)
+            self.after_move(job.model, job.destination)
+
+    def queue_ffmpeg(self, model_name, source_fn, destination_fn):
+        """
+        Queues a recording to be postprocessed by ffmpeg.
+
+        Jobs run in ``fifo`` order, or smallest file first when the order
+        is ``shortest``.
 
         :param str model_name: Model name.
         :param str source_fn: Source file, normally the flv file.
         :param str destination_fn: Destination file, normally a mp4.
         """
+        number = next(self.transcode_ids)
+        job = Job('ffmpeg-%s-%d' % (model_name, number), 'ffmpeg',
+                  model_name, state=ProcessRegistry.QUEUED,
+                  source=source_fn, destination=destination_fn)
+
+        priority = 0
+        if self.config['ffmpeg-order'] == 'shortest':
+            priority = os.path.getsize(source_fn)
+
+        self.processes.add(job)
+        if self.journal is not None:
+            self.journal.record(source_fn, job)
+        with self.transcode_lock:
+            heapq.heappush(self.transcodes, (priority, number, job))
+        self.start_transcodes()
+
+    def start_transcodes(self):
+        """
+        Starts queued transcodes while there are free ffmpeg workers.
+
+        Transcodes are paused while the completed path is low on space.
+        """
+        with self.transcode_lock:
+            paused = bool(self.transcodes) and not self.storage.has_room(
+                self.config['completed_path'])
+            if paused != self.transcodes_paused:
+                self.transcodes_paused = paused
+                if paused:
+                    self.log.warning("Low disk space in %s, pausing "
+                                     "transcodes",
+                                     self.config['completed_path'])
+                else:
+                    self.log.info("Resuming transcodes")
+            while not paused and self.transcodes and \
+                    self.processes.count(ProcessRegistry.TRANSCODING) < \
+                    self.config['ffmpeg-workers']:
+                job = heapq.heappop(self.transcodes)[2]
+                self.processes.set_state(job, ProcessRegistry.TRANSCODING)
+                try:
+                    self.run_ffmpeg(job)
+                except OSError:
+                    self.log.exception("Unable to start ffmpeg")
+                    self.processes.remove(job)
+
+    def transcode_wait(self):
+        """
+        Returns how long the oldest queued transcode has been waiting.
+
+        :return: Seconds.
+        :rtype: int
+        """
+        with self.transcode_lock:
+            if not self.transcodes:
+                return 0
+            oldest = min(job.time for _, _, job in self.transcodes)
+        return int(time.time()) - oldest
+
+    def ffmpeg_arguments(self, source_fn, destination_fn):
+        """
+        Builds the ffmpeg command line.
+
+        :param str source_fn: Source file, ``-`` for stdin.
+        :param str destination_fn: Destination file.
+
+        :rtype: list
+        """
         arguments = [
             ['ffmpeg', '-nostats', '-loglevel', '-8', '-y', '-threads', '2', '-i', source_fn],
             self.config['ffmpeg-flags'].split(),
             [destination_fn],
         ]
 
-        arguments = [item for sublist in arguments for item in sublist]
+        return [item for sublist in arguments for item in sublist]
 
-        if self.config['debug'] == 'true':
-            self.log.info("Running: %s", ' '.join(arguments))
+    def run_ffmpeg(self, job):
+        """
+        Executes ffmpeg to postprocess recording.
+
+        :param Job job: The transcode job, with the source and destination.
+        """
+        arguments = self.ffmpeg_arguments(job.source, job.destination)
 
-        process = subprocess.Popen(arguments)
+        if self.config['ffmpeg-ionice']:
+            arguments = ['ionice', '-c', self.config['ffmpeg-ionice']] + \
+                arguments
 
-        self.processes.append(
-            {
-                'id': 'ffmpeg-' + model_name,
-                'type': 'ffmpeg',
-                'model': model_name,
-                'source': source_fn,
-                'destination': destination_fn,
-                'process': process,
-            })
+        # nice(1) rather than a preexec_fn, which isn't safe with threads
+        if self.config['ffmpeg-nice'] > 0 and hasattr(os, 'nice'):
+            arguments = ['nice', '-n', str(self.config['ffmpeg-nice'])] + \
+                arguments
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Running: %s (waited %ds)", ' '.join(arguments),
+                           int(time.time()) - job.time)
+
+        job.process = subprocess.Popen(arguments)
+        job.time = int(time.time())
+        if self.journal is not None:
+            self.journal.record(job.source, job)
+
+        self.supervise(job)
 
 
 if __name__ == "__main__":
     c = Chaturbate()
     while True:
         try:
-            c.do_cycle()
-            time.sleep(60)
+            if c.scheduler.due():
+                c.do_cycle()
+            else:
+                c.recheck()
+            c.scheduler.sleep()
         except KeyboardInterrupt:
             c.kill_processes()
             sys.exit()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""
+Asynchronous daemon for :mod:`chaturbate`.
+
+Discovery, probing, process supervision, finalization and status reporting
+run as concurrent tasks of a single asyncio event loop, so a slow step no
+longer stalls the others. The blocking work (requests, the followed cams
+parsing, the private show probes) runs in thread pools through the
+methods of :class:`chaturbate.Chaturbate`, which is still the synchronous
+recorder used by ``python chaturbate.py``.
+
+Every probe is its own task, so a cycle only lasts as long as the followed
+cams fetch, however many models are being probed.
+
+Usage::
+
+    $ python daemon.py
+
+Requires Python 3.5 or newer.
+"""
+
+import sys
+import time
+import asyncio
+import concurrent.futures
+
+import chaturbate
+
+SUPERVISE_INTERVAL = 1
+"""Seconds between the checks of the running processes."""
+MAINTAIN_INTERVAL = 10
+"""Seconds between the cluster, storage and transcode housekeeping."""
+SAMPLE_INTERVAL = 5
+"""Seconds between the samples of the captures, to find stalls early."""
+RECHECK_INTERVAL = 1
+"""Longest wait between two looks at the fast re-checks."""
+
+
+class Daemon(object):
+    """
+    Drives a :class:`chaturbate.Chaturbate` from an event loop.
+
+    :param recorder: The recorder.
+    :param loop: The event loop, a new one by default.
+    """
+
+    def __init__(self, recorder, loop=None):
+        self.recorder = recorder
+        self.loop = loop or asyncio.new_event_loop()
+        # discovery gets its own thread so probes never delay a cycle
+        self.fetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.prober = concurrent.futures.ThreadPoolExecutor(
+            max_workers=recorder.config['workers'])
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.probing = set()
+        self.tasks = []
+
+    def call(self, executor, function, *args):
+        """
+        Runs a blocking function in a thread pool.
+
+        :rtype: asyncio.Future
+        """
+        return self.loop.run_in_executor(executor, function, *args)
+
+    async def every(self, seconds, function):
+        """
+        Calls a blocking function periodically, logging its errors.
+
+        :param float seconds: Seconds between two calls.
+        :param function: The function.
+        """
+        while True:
+            try:
+                await self.call(self.worker, function)
+            except Exception:
+                self.recorder.log.exception("%s failed", function.__name__)
+            await asyncio.sleep(seconds)
+
+    def probe(self, models):
+        """
+        Starts a probe task for every model not being probed or recorded.
+
+        :param list models: The model names.
+        """
+        for model in models:
+            if model in self.probing or self.recorder.is_recording(model):
+                continue
+            self.probing.add(model)
+            asyncio.ensure_future(self.probe_model(model), loop=self.loop)
+
+    async def probe_model(self, model):
+        """
+        Fetches the embed info of a model, probes it and starts capturing.
+
+        :param str model: The model name.
+        """
+        try:
+            await self.call(self.prober, self.recorder.process_model, model)
+        except Exception:
+            self.recorder.log.exception("Failed to process %s", model)
+        finally:
+            self.probing.discard(model)
+
+    async def discover(self):
+        """
+        Runs a cycle whenever the scheduler says so.
+        """
+        recorder = self.recorder
+        scheduler = recorder.scheduler
+        while True:
+            delay = scheduler.deadline - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = time.time()
+            scheduler.start_cycle()
+            try:
+                models = await self.call(self.fetcher, recorder.find_models)
+            except Exception:
+                recorder.log.exception("Discovery failed")
+                models = []
+            self.probe(models)
+            recorder.cycle_time = time.time() - started
+            scheduler.finish_cycle()
+            recorder.interval = scheduler.interval
+
+    async def recheck(self):
+        """
+        Starts the fast re-checks as they become due.
+        """
+        scheduler = self.recorder.scheduler
+        while True:
+            self.probe(self.recorder.due_rechecks())
+            wake = scheduler.next_recheck()
+            delay = RECHECK_INTERVAL
+            if wake is not None:
+                delay = min(max(wake - time.time(), 0), RECHECK_INTERVAL)
+            await asyncio.sleep(delay)
+
+    async def report(self):
+        """
+        Reports the status once per interval.
+        """
+        while True:
+            await asyncio.sleep(self.recorder.interval)
+            try:
+                await self.call(self.worker, self.recorder.report)
+            except Exception:
+                self.recorder.log.exception("Status report failed")
+
+    def start(self):
+        """
+        Creates the tasks on the event loop.
+        """
+        recorder = self.recorder
+        self.tasks = [
+            asyncio.ensure_future(coroutine, loop=self.loop)
+            for coroutine in (
+                self.discover(),
+                self.recheck(),
+                self.every(SUPERVISE_INTERVAL, recorder.is_running),
+                self.every(MAINTAIN_INTERVAL, recorder.maintain),
+                self.every(SAMPLE_INTERVAL, recorder.sample_captures),
+                self.report(),
+            )]
+
+    def run_forever(self):
+        """
+        Runs the daemon until it is interrupted.
+        """
+        self.start()
+        try:
+            self.loop.run_forever()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.prober.shutdown(wait=False)
+            self.fetcher.shutdown(wait=False)
+            self.worker.shutdown(wait=False)
+
+
+def main():
+    """
+    Starts the recorder and runs it on the event loop.
+    """
+    recorder = chaturbate.Chaturbate()
+    daemon = Daemon(recorder)
+    try:
+        daemon.run_forever()
+    except KeyboardInterrupt:
+        recorder.kill_processes()
+        sys.exit()
+
+
+if __name__ == "__main__":
+    main()
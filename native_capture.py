@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+In-process capture engine for :mod:`chaturbate`.
+
+Streams are read over HTTP, either as a progressive FLV download or as an HLS
+playlist, by coroutines multiplexed on a single asyncio event loop running in
+a background thread. Many streams can be recorded without spawning one
+rtmpdump process per stream.
+
+Requires Python 3.5 or newer.
+"""
+
+import asyncio
+import ssl
+import threading
+from urllib.parse import urljoin, urlsplit
+
+BUFFER_SIZE = 1024 * 1024
+"""Size of the write buffer of each recording."""
+READ_SIZE = 65536
+"""Bytes requested from the socket on each read."""
+MAX_REDIRECTS = 5
+"""How many redirects are followed."""
+
+
+class StreamError(Exception):
+    """
+    Raised when a stream can't be opened or stops sending data.
+    """
+
+
+async def open_stream(url, timeout, redirects=MAX_REDIRECTS):
+    """
+    Sends a GET request and reads the response headers.
+
+    :param str url: The URL to open.
+    :param float timeout: Seconds to wait for the connection and headers.
+    :param int redirects: How many more redirects may be followed.
+
+    :return: The reader, the writer and the lowercased headers.
+    :rtype: tuple
+    """
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    context = ssl.create_default_context() if secure else None
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port, ssl=context),
+        timeout)
+    writer.write(('GET %s HTTP/1.1\r\n'
+                  'Host: %s\r\n'
+                  'User-Agent: chaturbate.py\r\n'
+                  'Accept: */*\r\n'
+                  'Connection: close\r\n\r\n' % (path, parts.netloc))
+                 .encode('latin-1'))
+
+    try:
+        status = await asyncio.wait_for(reader.readline(), timeout)
+        fields = status.decode('latin-1').split(None, 2)
+        if len(fields) < 2 or not fields[1].isdigit():
+            raise StreamError("invalid response from %s" % url)
+        code = int(fields[1])
+
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            line = line.decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    except BaseException:
+        writer.close()
+        raise
+
+    if code in (301, 302, 303, 307, 308) and 'location' in headers:
+        writer.close()
+        if redirects == 0:
+            raise StreamError("too many redirects for %s" % url)
+        return await open_stream(urljoin(url, headers['location']), timeout,
+                                 redirects - 1)
+
+    if code != 200:
+        writer.close()
+        raise StreamError("%s returned %d" % (url, code))
+
+    return reader, writer, headers
+
+
+async def read_body(reader, headers, sink, timeout):
+    """
+    Reads a response body and hands every piece of it to ``sink``.
+
+    Supports chunked, fixed length and read-until-close bodies.
+
+    :param reader: The stream reader.
+    :param dict headers: The response headers.
+    :param sink: Called with every piece of the body.
+    :param float timeout: Seconds without data before giving up.
+    """
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                return
+            while size > 0:
+                data = await asyncio.wait_for(
+                    reader.read(min(size, READ_SIZE)), timeout)
+                if not data:
+                    raise StreamError("connection closed mid chunk")
+                sink(data)
+                size -= len(data)
+            await asyncio.wait_for(reader.readline(), timeout)
+
+    remaining = None
+    if 'content-length' in headers:
+        remaining = int(headers['content-length'])
+
+    while remaining is None or remaining > 0:
+        size = READ_SIZE if remaining is None else min(remaining, READ_SIZE)
+        data = await asyncio.wait_for(reader.read(size), timeout)
+        if not data:
+            if remaining is not None:
+                raise StreamError("connection closed early")
+            return
+        sink(data)
+        if remaining is not None:
+            remaining -= len(data)
+
+
+async def fetch(url, timeout):
+    """
+    Downloads a whole resource, used for playlists and HLS segments.
+
+    :param str url: The URL to download.
+    :param float timeout: Seconds without data before giving up.
+
+    :rtype: bytes
+    """
+    reader, writer, headers = await open_stream(url, timeout)
+    parts = []
+    try:
+        await read_body(reader, headers, parts.append, timeout)
+    finally:
+        writer.close()
+    return b''.join(parts)
+
+
+def parse_playlist(url, text):
+    """
+    Reads the segments of an HLS media playlist.
+
+    Master playlists are followed to their last (normally the best) variant.
+
+    :param str url: URL of the playlist, to resolve relative URIs.
+    :param str text: The playlist.
+
+    :return: The segment (or variant) URLs, the media sequence, the target
+             duration, whether the playlist has ended and whether it is a
+             master playlist.
+    :rtype: tuple
+    """
+    uris = []
+    sequence = 0
+    target = 2.0
+    ended = False
+    master = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target = float(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif line.startswith('#EXT-X-STREAM-INF'):
+            master = True
+        elif not line.startswith('#'):
+            uris.append(urljoin(url, line))
+    return uris, sequence, target, ended, master
+
+
+class Recording(object):
+    """
+    What a running capture has written so far.
+    """
+
+    def __init__(self, output, first_byte=None):
+        self.output = output
+        self.bytes = 0
+        self.first_byte = first_byte
+
+    def write(self, data):
+        """
+        Writes a piece of the stream.
+
+        :param bytes data: The data.
+        """
+        if self.bytes == 0 and data and self.first_byte is not None:
+            self.first_byte()
+        self.output.write(data)
+        self.bytes += len(data)
+
+
+async def copy_progressive(url, recording, timeout):
+    """
+    Records a progressive (HTTP-FLV) stream until it ends.
+    """
+    reader, writer, headers = await open_stream(url, timeout)
+    try:
+        await read_body(reader, headers, recording.write, timeout)
+    finally:
+        writer.close()
+
+
+async def copy_hls(url, recording, timeout):
+    """
+    Records an HLS stream, polling its playlist, until it ends.
+    """
+    last = -1
+    while True:
+        text = (await fetch(url, timeout)).decode('utf-8', 'replace')
+        uris, sequence, target, ended, master = parse_playlist(url, text)
+        if master:
+            if not uris:
+                raise StreamError("empty master playlist %s" % url)
+            url = uris[-1]
+            continue
+
+        for number, uri in enumerate(uris, sequence):
+            if number > last:
+                recording.write(await fetch(uri, timeout))
+                last = number
+
+        if ended:
+            return
+        await asyncio.sleep(max(target / 2, 0.5))
+
+
+def is_hls(url):
+    """
+    Checks if an URL is an HLS playlist.
+
+    :rtype: bool
+    """
+    return urlsplit(url).path.endswith('.m3u8')
+
+
+def copy_stream(url, recording, timeout):
+    """
+    Picks the coroutine to record an URL.
+
+    :rtype: coroutine
+    """
+    if is_hls(url):
+        return copy_hls(url, recording, timeout)
+    return copy_progressive(url, recording, timeout)
+
+
+async def record(url, filename, timeout, output=None, first_byte=None):
+    """
+    Records a stream into a file with a large write buffer.
+
+    :param output: A file-like object to write to instead of ``filename``.
+    :param first_byte: Called when the first data arrives, before it is
+                       buffered.
+
+    :return: How many bytes were written.
+    :rtype: int
+    """
+    if output is None:
+        output = open(filename, 'wb', buffering=BUFFER_SIZE)
+    recording = Recording(output, first_byte)
+    try:
+        await copy_stream(url, recording, timeout)
+    except (StreamError, OSError, asyncio.TimeoutError, ValueError):
+        # the stream stopped, keep what was recorded like rtmpdump does
+        pass
+    finally:
+        output.close()
+    return recording.bytes
+
+
+class FirstBytes(Exception):
+    """
+    Used to stop a probe as soon as data arrives.
+    """
+
+
+class Probe(object):
+    """
+    A :class:`Recording` lookalike that stops at the first byte.
+    """
+
+    def write(self, data):
+        if data:
+            raise FirstBytes()
+
+
+async def probe(url, timeout):
+    """
+    Checks if a stream sends data.
+
+    :rtype: bool
+    """
+    try:
+        await asyncio.wait_for(copy_stream(url, Probe(), timeout), timeout)
+    except FirstBytes:
+        return True
+    except (StreamError, OSError, asyncio.TimeoutError, ValueError):
+        pass
+    return False
+
+
+class NativeCapture(object):
+    """
+    Popen-like handle of a capture running on the :class:`NativeEngine`.
+
+    ``returncode`` is 0 when the stream ended after some data was written,
+    1 when nothing was recorded and -15 when it was terminated. It is only
+    set once the task is over, after the recording was flushed and closed.
+    """
+    pid = None
+
+    def __init__(self, engine, coroutine):
+        self.engine = engine
+        self.task = None
+        self.returncode = None
+        self.done = threading.Event()
+        engine.loop.call_soon_threadsafe(self.start, coroutine)
+
+    def start(self, coroutine):
+        """
+        Creates the task, on the loop thread.
+        """
+        self.task = self.engine.loop.create_task(coroutine)
+        self.task.add_done_callback(self.finish)
+
+    def finish(self, task):
+        """
+        Sets the return code when the task is over, on the loop thread.
+        """
+        if task.cancelled():
+            self.returncode = -15
+        elif task.exception() is not None:
+            self.returncode = 1
+        else:
+            self.returncode = 0 if task.result() > 0 else 1
+        self.done.set()
+
+    def poll(self):
+        """
+        :return: None while the capture is running.
+        """
+        return self.returncode
+
+    def wait(self):
+        """
+        Waits until the capture ends and its file is closed.
+        """
+        self.done.wait()
+        return self.returncode
+
+    def cancel(self):
+        """
+        Cancels the task, on the loop thread.
+        """
+        # start() was scheduled first, so the task always exists here
+        self.task.cancel()
+
+    def terminate(self):
+        """
+        Stops the capture, the data already received is kept.
+        """
+        self.engine.loop.call_soon_threadsafe(self.cancel)
+
+    kill = terminate
+
+
+class NativeEngine(object):
+    """
+    Runs the captures as tasks of one event loop in a background thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def capture(self, url, filename, timeout, output=None, first_byte=None):
+        """
+        Starts recording a stream.
+
+        :param str url: The stream URL.
+        :param str filename: Where to write it.
+        :param float timeout: Seconds without data before it is considered
+                              over.
+        :param output: A file-like object to write to instead of
+                       ``filename``.
+        :param first_byte: Called on the loop thread when the first data
+                           arrives.
+
+        :rtype: NativeCapture
+        """
+        return NativeCapture(self, record(url, filename, timeout, output,
+                                          first_byte))
+
+    def probe(self, url, timeout):
+        """
+        Checks if a stream sends data, blocking for at most ``timeout``.
+
+        :param str url: The stream URL.
+        :param float timeout: Seconds to wait for the first bytes.
+
+        :rtype: bool
+        """
+        future = asyncio.run_coroutine_threadsafe(probe(url, timeout),
+                                                  self.loop)
+        return future.result()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+Tests of :mod:`chaturbate` against local stand-in servers.
+
+Run with::
+
+    $ python -m unittest test_chaturbate
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import logging
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    raise unittest.SkipTest("the stand-in servers need Python 3")
+
+import chaturbate
+import native_capture
+import requests
+
+LIVE_SIZE = 300000
+"""Bytes the live stream sends before it goes quiet, less than a buffer."""
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """
+    Serves a live FLV stream that stops sending but stays connected.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/x-flv')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'\0' * LIVE_SIZE)
+        self.wfile.flush()
+        self.server.sent.set()
+        self.server.release.wait(30)
+
+    def log_message(self, *args):
+        pass
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """
+    A site that fails on demand.
+
+    ``/flaky`` fails twice then works, ``/down`` always fails, ``/hang``
+    never answers and every other page works.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] = \
+                self.server.hits.get(self.path, 0) + 1
+            hits = self.server.hits[self.path]
+        if self.path == '/hang':
+            self.server.release.wait(30)
+            return
+        if self.path == '/down' or (self.path == '/flaky' and hits <= 2):
+            self.reply(503, b'unavailable')
+        else:
+            self.reply(200, b'<div id="user_information"></div>')
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(handler):
+    """
+    Starts a stand-in server in a background thread.
+
+    :return: The server and its URL.
+    :rtype: tuple
+    """
+    server = Server(('127.0.0.1', 0), handler)
+    server.sent = threading.Event()
+    server.release = threading.Event()
+    server.lock = threading.Lock()
+    server.hits = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_port
+
+
+def stop_server(server):
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def recorder():
+    """
+    Returns a recorder with only what the tested methods use.
+
+    :rtype: chaturbate.Chaturbate
+    """
+    instance = chaturbate.Chaturbate.__new__(chaturbate.Chaturbate)
+    instance.processes = chaturbate.ProcessRegistry()
+    return instance
+
+
+class KillProcessesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.recorder = recorder()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, model, process, filename):
+        self.recorder.processes.add(chaturbate.Job(
+            'rtmp-' + model, 'rtmpdump', model, process=process,
+            state=chaturbate.ProcessRegistry.CAPTURING, filename=filename))
+
+    def test_native_capture_is_flushed(self):
+        server, url = start_server(StreamHandler)
+        engine = native_capture.NativeEngine()
+        try:
+            filename = os.path.join(self.directory, 'native.flv')
+            self.add('native', engine.capture(url, filename, 30), filename)
+            self.assertTrue(server.sent.wait(5))
+            # give the loop time to read it, it stays in the write buffer
+            time.sleep(0.5)
+
+            self.recorder.kill_processes()
+            # what ^C does next, nothing may be left in a buffer
+            self.assertEqual(os.path.getsize(filename), LIVE_SIZE)
+        finally:
+            stop_server(server)
+            engine.loop.call_soon_threadsafe(engine.loop.stop)
+            engine.thread.join()
+            engine.loop.close()
+
+    def test_piped_capture_is_flushed(self):
+        filename = os.path.join(self.directory, 'piped.flv')
+        output = chaturbate.SegmentWriter(
+            filename, lambda: filename + '.next', lambda *args: None,
+            size=1024 * 1024 * 1024, flv=False)
+        child = subprocess.Popen(
+            [sys.executable, '-c',
+             'import os, sys, time\n'
+             'os.write(sys.stdout.fileno(), b"\\0" * %d)\n'
+             'time.sleep(30)\n' % LIVE_SIZE],
+            stdout=subprocess.PIPE)
+        self.add('piped', chaturbate.PipedCapture(child, output), filename)
+        deadline = time.time() + 5
+        while output.written < LIVE_SIZE and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(output.written, LIVE_SIZE)
+
+        self.recorder.kill_processes()
+        self.assertEqual(os.path.getsize(filename), LIVE_SIZE)
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_server(SiteHandler)
+        self.recorder = recorder()
+        self.recorder.config = dict(chaturbate.Chaturbate.config, **{
+            'http-backoff': 0.01, 'http-max-backoff': 0.05})
+        self.recorder.log = logging.getLogger('test_chaturbate')
+        self.recorder.log.disabled = True
+        self.recorder.request = requests.Session()
+        self.recorder.timeout = (1, 0.5)
+        self.recorder.counters = chaturbate.EventCounter()
+        self.recorder.metrics = chaturbate.Metrics()
+        self.recorder.metrics.histogram('chaturbate_request_seconds', '')
+        self.recorder.retry_budget = chaturbate.RetryBudget()
+        self.recorder.breaker = chaturbate.CircuitBreaker(threshold=100)
+
+    def tearDown(self):
+        self.recorder.request.close()
+        stop_server(self.server)
+
+    def send(self, path):
+        return self.recorder.send('get', self.url + path)
+
+    def test_retries_until_success(self):
+        self.assertEqual(self.send('flaky').status_code, 200)
+        self.assertEqual(self.server.hits['/flaky'], 3)
+        self.assertEqual(self.recorder.counters.total('http_retry'), 2)
+        self.assertFalse(self.recorder.breaker.is_open())
+
+    def test_budget_exhausted(self):
+        self.recorder.retry_budget = chaturbate.RetryBudget(ratio=0,
+                                                            capacity=2)
+        with self.assertRaisesRegex(chaturbate.RequestError, 'budget'):
+            self.send('down')
+        # the first try and the two retries the budget allowed
+        self.assertEqual(self.server.hits['/down'], 3)
+        self.assertEqual(
+            self.recorder.counters.total('http_budget_exhausted'), 1)
+
+    def test_breaker_opens_and_half_opens(self):
+        breaker = chaturbate.CircuitBreaker(threshold=2, cooldown=0.3)
+        self.recorder.breaker = breaker
+        with self.assertRaisesRegex(chaturbate.RequestError, 'breaker'):
+            self.send('down')
+        self.assertTrue(breaker.is_open())
+        self.assertEqual(self.server.hits['/down'], 2)
+
+        # open, nothing reaches the site
+        with self.assertRaisesRegex(chaturbate.RequestError, 'breaker'):
+            self.send('ok')
+        self.assertNotIn('/ok', self.server.hits)
+
+        # half open after the cooldown, one failure opens it again
+        time.sleep(0.3)
+        with self.assertRaisesRegex(chaturbate.RequestError, 'breaker'):
+            self.send('down')
+        self.assertEqual(self.server.hits['/down'], 3)
+
+        # half open again, a success closes it
+        time.sleep(0.3)
+        self.assertEqual(self.send('ok').status_code, 200)
+        self.assertFalse(breaker.is_open())
+
+    def test_timeout(self):
+        self.recorder.retry_budget = chaturbate.RetryBudget(ratio=0,
+                                                            capacity=1)
+        with self.assertRaises(chaturbate.RequestError):
+            self.send('hang')
+        self.assertEqual(self.server.hits['/hang'], 2)
+        # failed requests are timed too
+        self.assertEqual(self.recorder.metrics.histograms[
+            'chaturbate_request_seconds'][2], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
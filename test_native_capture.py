@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+Tests of :mod:`native_capture` against a local stand-in stream server.
+
+Run with::
+
+    $ python -m unittest test_native_capture
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    raise unittest.SkipTest("the native capture needs Python 3.5+")
+
+import native_capture
+
+LIVE_SIZE = 200000
+"""Bytes the live stream sends before it goes quiet, less than a buffer."""
+ENDED_SIZE = 5000
+"""Bytes the ended stream sends before it closes."""
+SEGMENT = b'segment'
+"""Body of every HLS segment."""
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """
+    Serves a live FLV stream, a stream that ends, a playlist and 404s.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/live.flv':
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/x-flv')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'\0' * LIVE_SIZE)
+            self.wfile.flush()
+            self.server.sent.set()
+            # a live stream that stops sending but stays connected
+            self.server.release.wait(30)
+        elif self.path == '/ended.flv':
+            self.reply(b'\1' * ENDED_SIZE)
+        elif self.path == '/play.m3u8':
+            self.reply(b'#EXTM3U\n'
+                       b'#EXT-X-TARGETDURATION:1\n'
+                       b'#EXT-X-MEDIA-SEQUENCE:0\n'
+                       b'0.ts\n'
+                       b'1.ts\n'
+                       b'#EXT-X-ENDLIST\n')
+        elif self.path.endswith('.ts'):
+            self.reply(SEGMENT)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class NativeCaptureTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StreamServer(('127.0.0.1', 0), StreamHandler)
+        cls.server.sent = threading.Event()
+        cls.server.release = threading.Event()
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base_url = 'http://127.0.0.1:%d/' % cls.server.server_port
+        cls.engine = native_capture.NativeEngine()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.release.set()
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.engine.loop.call_soon_threadsafe(cls.engine.loop.stop)
+        cls.engine.thread.join()
+        cls.engine.loop.close()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture(self, path, timeout=5):
+        filename = os.path.join(self.directory, 'capture.flv')
+        return self.engine.capture(self.base_url + path, filename,
+                                   timeout), filename
+
+    def test_probe(self):
+        self.assertTrue(self.engine.probe(self.base_url + 'live.flv', 5))
+        self.assertFalse(self.engine.probe(self.base_url + 'gone.flv', 5))
+
+    def test_end_of_stream(self):
+        process, filename = self.capture('ended.flv')
+        self.assertEqual(process.wait(), 0)
+        self.assertEqual(os.path.getsize(filename), ENDED_SIZE)
+
+    def test_first_byte(self):
+        arrived = []
+        filename = os.path.join(self.directory, 'capture.flv')
+        process = self.engine.capture(self.base_url + 'ended.flv', filename,
+                                      5, first_byte=lambda: arrived.append(
+                                          os.path.getsize(filename)))
+        self.assertEqual(process.wait(), 0)
+        # reported once, before anything was flushed
+        self.assertEqual(arrived, [0])
+
+    def test_hls(self):
+        process, filename = self.capture('play.m3u8')
+        self.assertEqual(process.wait(), 0)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), SEGMENT * 2)
+
+    def test_not_found(self):
+        process, filename = self.capture('gone.flv')
+        self.assertEqual(process.wait(), 1)
+        self.assertEqual(os.path.getsize(filename), 0)
+
+    def test_terminate(self):
+        self.server.sent.clear()
+        process, filename = self.capture('live.flv', timeout=30)
+        self.assertTrue(self.server.sent.wait(5))
+        # give the loop time to read it, it stays in the write buffer
+        time.sleep(0.5)
+        self.assertIsNone(process.poll())
+
+        process.terminate()
+        self.assertEqual(process.wait(), -15)
+        self.assertEqual(process.poll(), -15)
+        # wait() only returns once the buffer was flushed to the file
+        self.assertEqual(os.path.getsize(filename), LIVE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()